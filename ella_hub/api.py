@@ -1,10 +1,12 @@
-import datetime
+import json
 import ella_hub.resources
 
+from hashlib import md5
 from inspect import isclass
 
 from django.conf import settings
 from django.conf.urls import url
+from django.core.cache import cache
 from django.core.urlresolvers import reverse_lazy
 from django.core.exceptions import ImproperlyConfigured
 from django.contrib.auth import authenticate, login, logout
@@ -16,7 +18,7 @@ from django.contrib.auth import REDIRECT_FIELD_NAME
 
 from tastypie.api import Api
 from tastypie.exceptions import BadRequest, ImmediateHttpResponse
-from tastypie.http import HttpUnauthorized
+from tastypie.http import HttpUnauthorized, HttpBadRequest
 from tastypie.models import ApiKey
 from tastypie.resources import Resource, ModelResource
 from tastypie.serializers import Serializer
@@ -26,13 +28,20 @@ from tastypie.utils.mime import determine_format, build_content_type
 from ella.core.models import Publishable
 from ella.utils import timezone
 
-from ella_hub.models import PublishableLock
+from ella_hub.models import PublishableLock, State
 from ella_hub import utils
 from ella_hub.decorators import cross_domain_api_post_view
 from ella_hub.ella_resources import PublishableResource
-from ella_hub.utils.workflow import get_init_states, get_workflow
+from ella_hub.utils.cache import get_cache_version
+from ella_hub.utils.perms import PERMISSIONS_VERSION_KEY, get_role_signature
+from ella_hub.utils.perms import has_model_permission, REST_PERMS
+from ella_hub.utils.workflow import get_init_states, get_workflow, set_states, get_state_counts
+from ella_hub.utils.workflow import check_transitions
 from ella_hub.utils.timezone import now
-from ella_hub.auth import ApiAuthentication
+from ella_hub.auth import ApiAuthentication, get_authentication
+from ella_hub.auth import get_api_key_info, invalidate_api_key_info
+from ella_hub.auth import create_signed_token, revoke_signed_tokens
+from ella_hub.throttle import get_throttle, get_client_identifier, build_throttled_response
 from ella_hub import conf
 
 
@@ -159,6 +168,9 @@ class EllaHubApi(Api):
             url(r"^%s/login/$" % self.api_name, self.wrap_view('login_view')),
             url(r"^%s/logout/$" % self.api_name, self.wrap_view('logout_view')),
             url(r"^%s/validate-api-key/$" % self.api_name, self.wrap_view('validate_api_key_view')),
+            url(r"^%s/set-state/$" % self.api_name, self.wrap_view('set_state_view')),
+            url(r"^%s/check-transitions/$" % self.api_name, self.wrap_view('check_transitions_view')),
+            url(r"^%s/state-counts/(?P<resource_name>[\w-]+)/$" % self.api_name, self.wrap_view('state_counts_view')),
 
             url(r"^preview/(?P<id>\d+)/$", self.preview_publishable),
         ]
@@ -168,7 +180,7 @@ class EllaHubApi(Api):
         return csrf_exempt(wrapped_view)
 
     def ensure_authenticated(self, request):
-        authenticator = ApiAuthentication()
+        authenticator = get_authentication()
         auth_result = authenticator.is_authenticated(request)
 
         if isinstance(auth_result, HttpResponse):
@@ -177,8 +189,28 @@ class EllaHubApi(Api):
         if auth_result is not True:
             raise ImmediateHttpResponse(response=HttpUnauthorized())
 
+    def throttle_check(self, request, scope):
+        """
+        Throttles requests to API views by client identified by
+        ``get_client_identifier``, budget of every view is configured
+        by its scope in ``ELLA_HUB_THROTTLE_RATES``.
+        """
+        throttle = get_throttle(scope)
+        identifier = get_client_identifier(request)
+
+        if throttle.should_be_throttled(identifier):
+            raise ImmediateHttpResponse(
+                response=build_throttled_response(throttle, identifier))
+
+        throttle.accessed(identifier)
+
     @cross_domain_api_post_view
     def login_view(self, request):
+        try:
+            self.throttle_check(request, "login")
+        except ImmediateHttpResponse, e:
+            return e.response
+
         username = request.POST.get("username", "")
         password = request.POST.get("password", "")
         user = authenticate(username=username, password=password)
@@ -186,14 +218,19 @@ class EllaHubApi(Api):
         if user is not None and user.is_active:
             login(request, user)
 
-            api_key, created = ApiKey.objects.get_or_create(user=user,
-                                                            defaults={"created": now()})
-            return HttpJsonResponse({
-                "api_key": self.__regenerate_key(api_key),
-                "user_id": api_key.user_id,
-                "auth_tree": self.__create_auth_tree(request),
-                "system": self.__get_system_info(request),
+            if conf.SIGNED_TOKEN_AUTHENTICATION:
+                key = create_signed_token(user)
+            else:
+                api_key, created = ApiKey.objects.get_or_create(user=user,
+                                                                defaults={"created": now()})
+                key = self.__regenerate_key(api_key)
+
+            payload = self.__get_login_payload(request)
+            payload.update({
+                "api_key": key,
+                "user_id": user.pk,
             })
+            return HttpJsonResponse(payload)
         else:
             return HttpUnauthorized()
 
@@ -204,12 +241,16 @@ class EllaHubApi(Api):
         except ImmediateHttpResponse, e:
             return e.response
 
-        try:
-            api_key = ApiKey.objects.get(user=request.user)
-        except ApiKey.DoesNotExist:
-            return HttpUnauthorized()
+        if conf.SIGNED_TOKEN_AUTHENTICATION:
+            revoke_signed_tokens(request.user)
+        else:
+            try:
+                api_key = ApiKey.objects.get(user=request.user)
+            except ApiKey.DoesNotExist:
+                return HttpUnauthorized()
+
+            self.__regenerate_key(api_key)
 
-        self.__regenerate_key(api_key)
         logout(request)
 
         return HttpJsonResponse({
@@ -218,19 +259,26 @@ class EllaHubApi(Api):
 
     @cross_domain_api_post_view
     def validate_api_key_view(self, request):
+        try:
+            self.throttle_check(request, "validate_api_key")
+        except ImmediateHttpResponse, e:
+            return e.response
+
         try:
             self.ensure_authenticated(request)
         except:
             return self.__build_response(False)
 
-        try:
-            api_key = ApiKey.objects.get(user=request.user)
-        except ApiKey.DoesNotExist:
+        if conf.SIGNED_TOKEN_AUTHENTICATION:
+            # token expiration was verified by authentication
+            return self.__build_response(True)
+
+        authenticator = ApiAuthentication()
+        api_key = get_api_key_info(*authenticator.extract_credentials(request))
+        if api_key is None:
             return self.__build_response(False)
         else:
-            expiration_time = api_key.created + datetime.timedelta(
-                days=conf.API_KEY_EXPIRATION_IN_DAYS)
-            return self.__build_response(timezone.now() < expiration_time)
+            return self.__build_response(not authenticator.is_api_key_expired(api_key))
 
     def __build_response(self, api_key_validity):
         return HttpJsonResponse({
@@ -238,11 +286,116 @@ class EllaHubApi(Api):
         })
 
     def __regenerate_key(self, api_key):
+        invalidate_api_key_info(api_key.user.username, api_key.key)
         api_key.key = api_key.generate_key()
         api_key.created = timezone.now()
         api_key.save()
         return api_key.key
 
+    @cross_domain_api_post_view
+    def set_state_view(self, request):
+        """
+        Sets state of many objects of one resource at once. Expects JSON
+        {"resource": <name>, "ids": [<id>, ...], "state": <codename>}.
+        """
+        try:
+            self.ensure_authenticated(request)
+        except ImmediateHttpResponse, e:
+            return e.response
+
+        try:
+            data = json.loads(request.body)
+            resource_name, state_codename = data["resource"], data["state"]
+            ids = [int(pk) for pk in data["ids"]]
+        except (ValueError, TypeError, KeyError):
+            return HttpBadRequest("Resource name, list of IDs and state are required.")
+
+        if resource_name not in self._registry:
+            return HttpBadRequest("Unknown resource %s." % resource_name)
+
+        model = self._registry[resource_name]._meta.object_class
+        if not has_model_permission(model, request.user, REST_PERMS["PATCH"]):
+            return HttpUnauthorized()
+
+        workflow = get_workflow(model)
+        states = State.objects.filter(codename=state_codename)
+        if workflow:
+            states = states.filter(workflow=workflow)
+        try:
+            state = states[0]
+        except IndexError:
+            return HttpBadRequest("Unknown state %s." % state_codename)
+
+        # roles need permission to change object in its current state
+        results = set_states(model, ids, state, user=request.user, permission="can_change")
+
+        objects = []
+        for pk in ids:
+            result = {"id": pk, "success": results[pk] is None}
+            if results[pk] is not None:
+                result["error"] = results[pk]
+            objects.append(result)
+        return HttpJsonResponse({"objects": objects}, status=202)
+
+    @cross_domain_api_post_view
+    def check_transitions_view(self, request):
+        """
+        Tells which of many objects of one resource can be switched to which
+        states. Expects JSON {"resource": <name>, "ids": [<id>, ...], "states": [<codename>, ...]}.
+        """
+        try:
+            self.ensure_authenticated(request)
+        except ImmediateHttpResponse, e:
+            return e.response
+
+        try:
+            data = json.loads(request.body)
+            resource_name = data["resource"]
+            ids = [int(pk) for pk in data["ids"]]
+            codenames = [unicode(codename) for codename in data["states"]]
+        except (ValueError, TypeError, KeyError):
+            return HttpBadRequest("Resource name, list of IDs and list of states are required.")
+
+        if resource_name not in self._registry:
+            return HttpBadRequest("Unknown resource %s." % resource_name)
+
+        model = self._registry[resource_name]._meta.object_class
+        if not has_model_permission(model, request.user, REST_PERMS["GET"]):
+            return HttpUnauthorized()
+
+        results = check_transitions(model, ids, codenames, request.user)
+
+        objects = []
+        for pk in ids:
+            if results[pk] is None:
+                objects.append({"id": pk, "error": "Object does not exist."})
+            else:
+                objects.append({"id": pk, "states": results[pk]})
+        return HttpJsonResponse({"objects": objects})
+
+    def state_counts_view(self, request, resource_name):
+        """
+        Returns number of objects of resource in every state, optionally
+        only in category given by ``category`` parameter.
+        """
+        try:
+            self.ensure_authenticated(request)
+        except ImmediateHttpResponse, e:
+            return e.response
+
+        if resource_name not in self._registry:
+            return HttpBadRequest("Unknown resource %s." % resource_name)
+
+        model = self._registry[resource_name]._meta.object_class
+        if not has_model_permission(model, request.user, REST_PERMS["GET"]):
+            return HttpUnauthorized()
+
+        category = request.GET.get("category")
+        if category is not None and not category.isdigit():
+            return HttpBadRequest("Category has to be ID.")
+
+        return HttpJsonResponse(get_state_counts(model, category))
+
     @cross_domain_api_post_view
     def lock_publishable(self, request, id):
         try:
@@ -283,6 +436,28 @@ class EllaHubApi(Api):
 
         return HttpJsonResponse(payload, status=202)
 
+    def __get_login_payload(self, request):
+        """
+        Returns authorization tree and system info of login response.
+        They are the same for all users with the same roles so they are
+        cached by role signature until roles, permissions or workflows change.
+        """
+        cache_key = "HUB_login_payload_%s_%s_%s" % (
+            self.api_name,
+            get_cache_version(PERMISSIONS_VERSION_KEY),
+            md5(get_role_signature(request.user)).hexdigest(),
+        )
+        payload = cache.get(cache_key)
+
+        if payload is None:
+            payload = {
+                "auth_tree": self.__create_auth_tree(request),
+                "system": self.__get_system_info(request),
+            }
+            cache.set(cache_key, payload, timeout=conf.STATES_CACHE_TIMEOUT)
+
+        return payload
+
     def __get_system_info(self, request):
         system_info = {}
 
@@ -1,38 +1,172 @@
 import re
+import time
+import hashlib
 import datetime
+import threading
 
-from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.contenttypes.models import ContentType
+from django.core import signing
+from django.core.cache import cache
+from django.db.models import F, Q
+from django.utils.encoding import smart_str
 
 from tastypie.authentication import ApiKeyAuthentication as Authentication
 from tastypie.authorization import DjangoAuthorization
 from tastypie.exceptions import Unauthorized
 from tastypie.models import ApiKey
 
+from ella.core.cache import get_cached_object
 from ella.utils import timezone
 
+from ella_hub.models import StateObjectRelation, SignedTokenRevocation
 from ella_hub.utils import get_model_name_from_class
+from ella_hub.utils.perms import load_user_permissions, get_permission_matrix, has_object_permission
+from ella_hub.utils.perms import get_object_role_relations
 from ella_hub import conf
 
 
-class ApiAuthentication(Authentication):
-    def is_authenticated(self, request, **kwargs):
-        response = super(ApiAuthentication, self).is_authenticated(request, **kwargs)
-        if response is not True:
-            return response
+class ApiKeyInfo(object):
+    """
+    Cacheable subset of ``ApiKey`` needed to verify request credentials.
+    """
+
+    def __init__(self, id, user_id, created, is_active, cache_key):
+        self.id = id
+        self.user_id = user_id
+        self.created = created
+        self.is_active = is_active
+        self.cache_key = cache_key
+
+
+def get_api_key_cache_key(username, key):
+    return "HUB_api_key_%s" % hashlib.sha1(smart_str(u"%s:%s" % (username, key))).hexdigest()
+
 
-        username, key = self.extract_credentials(request)
+def get_api_key_info(username, key):
+    """
+    Returns `ApiKeyInfo` for given credentials or `None` if they are wrong.
+    """
+    cache_key = get_api_key_cache_key(username, key)
+    api_key_info = cache.get(cache_key)
+
+    if api_key_info is None:
         try:
-            api_key = ApiKey.objects.get(user__username=username, key=key)
+            api_key = ApiKey.objects.select_related('user').get(user__username=username, key=key)
         except ApiKey.DoesNotExist:
+            return None
+
+        api_key_info = ApiKeyInfo(
+            id=api_key.pk,
+            user_id=api_key.user_id,
+            created=api_key.created,
+            is_active=api_key.user.is_active,
+            cache_key=cache_key
+        )
+        cache.set(cache_key, api_key_info, timeout=conf.API_KEY_CACHE_TIMEOUT)
+
+    return api_key_info
+
+
+class PendingRefreshes(object):
+    """
+    Process-local queue of API key expiration refreshes.
+
+    Refresh times are rounded down to `API_KEY_REFRESH_INTERVAL`, so keys
+    refreshed in the same interval are written by a single UPDATE.
+    """
+
+    def __init__(self):
+        self._refreshes = {}
+        self._lock = threading.Lock()
+        self._flushed = time.time()
+
+    def add(self, api_key_id, created):
+        with self._lock:
+            self._refreshes[api_key_id] = created
+
+    def discard(self, api_key_id):
+        with self._lock:
+            self._refreshes.pop(api_key_id, None)
+
+    def is_due(self):
+        return bool(self._refreshes) and \
+            time.time() - self._flushed >= conf.API_KEY_REFRESH_FLUSH_INTERVAL
+
+    def flush(self):
+        """
+        Writes pending refreshes to database, returns number of refreshed keys.
+        """
+        with self._lock:
+            refreshes, self._refreshes = self._refreshes, {}
+            self._flushed = time.time()
+
+        ids_by_created = {}
+        for api_key_id, created in refreshes.items():
+            ids_by_created.setdefault(created, []).append(api_key_id)
+
+        for created, ids in ids_by_created.items():
+            # never move creation time of regenerated keys back
+            ApiKey.objects.filter(pk__in=ids, created__lt=created).update(created=created)
+
+        return len(refreshes)
+
+
+pending_refreshes = PendingRefreshes()
+
+
+def flush_api_key_refreshes():
+    """
+    Writes coalesced API key refreshes of this process to database.
+    Call it from a periodic hook (uWSGI timer, Celery beat, ...) when
+    `ELLA_HUB_API_KEY_REFRESH_INTERVAL` is set.
+    """
+    return pending_refreshes.flush()
+
+
+def round_down_time(value, seconds):
+    midnight = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    discard = (value - midnight).seconds % seconds
+    return value.replace(microsecond=0) - datetime.timedelta(seconds=discard)
+
+
+def invalidate_api_key_info(username, key):
+    """
+    Removes cached credentials, call it whenever API key or user changes.
+    """
+    cache.delete(get_api_key_cache_key(username, key))
+
+
+class ApiAuthentication(Authentication):
+    def is_authenticated(self, request, **kwargs):
+        try:
+            username, key = self.extract_credentials(request)
+        except ValueError:
+            return self._unauthorized()
+
+        if not username or not key:
+            return self._unauthorized()
+
+        api_key = get_api_key_info(username, key)
+        if api_key is None:
+            return self._unauthorized()
+
+        if not api_key.is_active:
             return False
 
         if self.is_api_key_expired(api_key):
             request.user = AnonymousUser()
             return False
-        else:
-            self.refresh_api_key_expiration_time(api_key)
-            request.user = api_key.user
-            return True
+
+        try:
+            user = get_cached_object(User, pk=api_key.user_id)
+        except User.DoesNotExist:
+            return self._unauthorized()
+
+        self.refresh_api_key_expiration_time(api_key)
+        load_user_permissions(user)
+        request.user = user
+        return True
 
     def is_api_key_expired(self, api_key):
         expiration_time = api_key.created + datetime.timedelta(
@@ -40,8 +174,149 @@ class ApiAuthentication(Authentication):
         return expiration_time <= timezone.now()
 
     def refresh_api_key_expiration_time(self, api_key):
-        api_key.created = timezone.now()
-        api_key.save()
+        """
+        Slides expiration time of API key. When `API_KEY_REFRESH_INTERVAL`
+        is set, key is refreshed at most once per interval and the write
+        is deferred to `flush_api_key_refreshes`, so expiration checks
+        are correct within the interval plus `API_KEY_REFRESH_FLUSH_INTERVAL`.
+        """
+        interval = conf.API_KEY_REFRESH_INTERVAL
+        now = timezone.now()
+
+        if not interval:
+            api_key.created = now
+            ApiKey.objects.filter(pk=api_key.id).update(created=api_key.created)
+            cache.set(api_key.cache_key, api_key, timeout=conf.API_KEY_CACHE_TIMEOUT)
+            return
+
+        if now - api_key.created < datetime.timedelta(seconds=interval):
+            return
+
+        api_key.created = round_down_time(now, interval)
+        cache.set(api_key.cache_key, api_key, timeout=conf.API_KEY_CACHE_TIMEOUT)
+        pending_refreshes.add(api_key.id, api_key.created)
+
+        if pending_refreshes.is_due():
+            pending_refreshes.flush()
+
+
+TOKEN_SALT = "ella_hub.auth.SignedTokenAuthentication"
+
+
+def get_token_lifetime():
+    return conf.API_KEY_EXPIRATION_IN_DAYS * 24 * 60 * 60
+
+
+def get_revocation_cache_key(user_id):
+    return "HUB_token_generation_%s" % user_id
+
+
+def get_token_generation(user_id):
+    """
+    Returns generation of tokens of user <user_id>, tokens of older
+    generations are revoked. Read through the Django cache.
+    """
+    cache_key = get_revocation_cache_key(user_id)
+    generation = cache.get(cache_key)
+    if generation is None:
+        generation = SignedTokenRevocation.objects.filter(
+            user=user_id).values_list("generation", flat=True).first() or 0
+        cache.set(cache_key, generation, timeout=get_token_lifetime())
+    return generation
+
+
+def create_signed_token(user):
+    """
+    Returns token signed by `SECRET_KEY` carrying user ID, generation
+    of user's tokens, time of issue and expiration time.
+    """
+    issued = time.time()
+    return signing.dumps({
+        "uid": user.pk,
+        "gen": get_token_generation(user.pk),
+        "iat": issued,
+        "exp": issued + get_token_lifetime(),
+    }, salt=TOKEN_SALT)
+
+
+def revoke_signed_tokens(user):
+    """
+    Invalidates all tokens issued to <user> so far.
+    """
+    revocation, created = SignedTokenRevocation.objects.get_or_create(user=user)
+    # incremented in database, so concurrent revocations don't get lost
+    SignedTokenRevocation.objects.filter(pk=revocation.pk).update(generation=F("generation") + 1)
+    invalidate_token_generation(user.pk)
+
+
+def invalidate_token_generation(user_id):
+    """
+    Removes cached generation of tokens of user <user_id>.
+    """
+    cache.delete(get_revocation_cache_key(user_id))
+
+
+def verify_signed_token(token):
+    """
+    Returns payload of valid token or `None`.
+    """
+    try:
+        payload = signing.loads(token, salt=TOKEN_SALT)
+    except signing.BadSignature:
+        return None
+
+    if payload["exp"] <= time.time():
+        return None
+
+    if payload.get("gen", 0) < get_token_generation(payload["uid"]):
+        return None
+
+    return payload
+
+
+class SignedTokenAuthentication(ApiAuthentication):
+    """
+    Verifies tokens created by `create_signed_token` instead of looking
+    them up in the ``ApiKey`` table. Tokens are sent in the same
+    "Authorization: ApiKey username:token" header.
+    """
+
+    def is_authenticated(self, request, **kwargs):
+        try:
+            username, token = self.extract_credentials(request)
+        except ValueError:
+            return self._unauthorized()
+
+        if not username or not token:
+            return self._unauthorized()
+
+        payload = verify_signed_token(token)
+        if payload is None:
+            return self._unauthorized()
+
+        try:
+            user = get_cached_object(User, pk=payload["uid"])
+        except User.DoesNotExist:
+            return self._unauthorized()
+
+        if user.username != username:
+            return self._unauthorized()
+
+        if not user.is_active:
+            return False
+
+        load_user_permissions(user)
+        request.user = user
+        return True
+
+
+def get_authentication():
+    """
+    Returns authentication configured by `ELLA_HUB_SIGNED_TOKEN_AUTHENTICATION`.
+    """
+    if conf.SIGNED_TOKEN_AUTHENTICATION:
+        return SignedTokenAuthentication()
+    return ApiAuthentication()
 
 
 class ApiAuthorization(DjangoAuthorization):
@@ -50,6 +325,12 @@ class ApiAuthorization(DjangoAuthorization):
     """
     # Regular Expression parsing resource name from `request.path`.
     __re_objects_class = re.compile(r"/[^/]*/(?P<resource_name>[^/]*)/.*")
+    # Permissions granted by object-scoped roles to users without model permission.
+    object_read_permission = "can_view"
+    object_change_permission = "can_change"
+    object_delete_permission = "can_delete"
+    # Permission required to list object in its state, None lists objects in all states.
+    state_read_permission = conf.STATE_READ_PERMISSION
 
     def read_list(self, object_list, bundle):
         klass = self.base_checks(bundle.request, object_list.model)
@@ -63,22 +344,68 @@ class ApiAuthorization(DjangoAuthorization):
         )
 
         if not bundle.request.user.has_perm(permission):
-            raise Unauthorized("You are not allowed to access that resource - %s" % (permission,))
+            relations = get_object_role_relations(bundle.request.user, klass,
+                self.object_read_permission)
+            if relations is None:
+                raise Unauthorized("You are not allowed to access that resource - %s" % (permission,))
+            # filtered in SQL like states, so page and total count agree
+            object_list = object_list.filter(pk__in=relations.values('content_id'))
+
+        return self.filter_by_states(object_list, bundle.request, klass)
+
+    def filter_by_states(self, object_list, request, klass):
+        """
+        Limits <object_list> to objects in states the user has
+        ``state_read_permission`` for, objects without state are in
+        initial state of the workflow. Models without workflow aren't limited.
+        """
+        user = request.user
+        if self.state_read_permission is None or user.is_superuser:
+            return object_list
+
+        content_type = ContentType.objects.get_for_model(klass)
+        matrix = get_permission_matrix()
+        workflow_id = matrix.workflows.get(content_type.pk)
+        if workflow_id is None:
+            return object_list
 
-        return object_list
+        # resolved once per request
+        if not hasattr(request, '_hub_readable_state_ids'):
+            request._hub_readable_state_ids = matrix.get_permitted_state_ids(
+                self.state_read_permission, matrix.get_user_mask(user))
+
+        # filtered in SQL, so page and total count agree
+        relations = StateObjectRelation.objects.filter(content_type=content_type)
+        readable = Q(pk__in=relations.filter(
+            state__in=request._hub_readable_state_ids).values('content_id'))
+        if matrix.initial_states.get(workflow_id) in request._hub_readable_state_ids:
+            readable |= ~Q(pk__in=relations.values('content_id'))
+        return object_list.filter(readable)
 
     def read_detail(self, object_list, bundle):
+        return self.check_object_permission(bundle, "change", self.object_read_permission)
+
+    def update_detail(self, object_list, bundle):
+        return self.check_object_permission(bundle, "change", self.object_change_permission)
+
+    def delete_detail(self, object_list, bundle):
+        return self.check_object_permission(bundle, "delete", self.object_delete_permission)
+
+    def check_object_permission(self, bundle, permission, codename):
+        """
+        Raises `Unauthorized` if user has neither model <permission>
+        nor permission <codename> granted by object-scoped role.
+        """
         klass = self.base_checks(bundle.request, bundle.obj.__class__)
 
         if klass is False:
             raise Unauthorized("You are not allowed to access that resource.")
 
-        permission = '%s.change_%s' % (
-            klass._meta.app_label,
-            get_model_name_from_class(klass),
-        )
-
-        if not bundle.request.user.has_perm(permission):
-            raise Unauthorized("You are not allowed to access that resource - %s" % (permission,))
+        if not has_object_permission(bundle.obj, bundle.request.user, permission, codename):
+            raise Unauthorized("You are not allowed to access that resource - %s.%s_%s" % (
+                klass._meta.app_label,
+                permission,
+                get_model_name_from_class(klass),
+            ))
 
         return True
@@ -2,6 +2,20 @@ from django.conf import settings
 
 API_KEY_EXPIRATION_IN_DAYS = getattr(settings, 'ELLA_HUB_API_KEY_EXPIRATION_IN_DAYS', 14)
 STATES_CACHE_TIMEOUT = getattr(settings, 'ELLA_HUB_STATES_CACHE_TIMEOUT', 5 * 60)
+STATES_LOCAL_CACHE_TIMEOUT = getattr(settings, 'ELLA_HUB_STATES_LOCAL_CACHE_TIMEOUT', 10)
+STATES_LOCAL_CACHE_SIZE = getattr(settings, 'ELLA_HUB_STATES_LOCAL_CACHE_SIZE', 1000)
 THUMBNAIL_FORMAT = getattr(settings, 'ELLA_HUB_THUMBNAIL_FORMAT', None)
 ALLOW_THUMBNAIL_FALLBACK = getattr(settings, 'ELLA_HUB_ALLOW_THUMBNAIL_FALLBACK', True)
 MEDIA_DRAFTS_DIR = getattr(settings, 'ELLA_HUB_MEDIA_DRAFTS_DIR', 'ella_hub_drafts')
+API_KEY_CACHE_TIMEOUT = getattr(settings, 'ELLA_HUB_API_KEY_CACHE_TIMEOUT', 5 * 60)
+API_KEY_REFRESH_INTERVAL = getattr(settings, 'ELLA_HUB_API_KEY_REFRESH_INTERVAL', 0)
+API_KEY_REFRESH_FLUSH_INTERVAL = getattr(settings, 'ELLA_HUB_API_KEY_REFRESH_FLUSH_INTERVAL', 60)
+SIGNED_TOKEN_AUTHENTICATION = getattr(settings, 'ELLA_HUB_SIGNED_TOKEN_AUTHENTICATION', False)
+USER_PERMISSIONS_CACHE_TIMEOUT = getattr(settings, 'ELLA_HUB_USER_PERMISSIONS_CACHE_TIMEOUT', 60 * 60)
+# permission (f.e. 'can_view') required to list object in its state, None doesn't filter lists by states
+STATE_READ_PERMISSION = getattr(settings, 'ELLA_HUB_STATE_READ_PERMISSION', None)
+SCHEDULED_TRANSITIONS_BATCH_SIZE = getattr(settings, 'ELLA_HUB_SCHEDULED_TRANSITIONS_BATCH_SIZE', 500)
+# (requests, seconds) per throttle scope, missing or None scope isn't throttled
+THROTTLE_RATES = getattr(settings, 'ELLA_HUB_THROTTLE_RATES', {})
+# request.META key (f.e. 'HTTP_X_FORWARDED_FOR' set by trusted proxy) or callable identifying client of login views
+THROTTLE_CLIENT_IDENTIFIER = getattr(settings, 'ELLA_HUB_THROTTLE_CLIENT_IDENTIFIER', 'REMOTE_ADDR')
@@ -4,9 +4,11 @@ import os
 
 from PIL import Image
 from tastypie import fields
+from tastypie.exceptions import BadRequest
 from tastypie.resources import ALL, ALL_WITH_RELATIONS
 
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.files.images import ImageFile
@@ -22,16 +24,18 @@ from ella.photos.conf import photos_settings
 from ella.utils.timezone import now
 
 from ella_hub.resources import ApiModelResource, MultipartFormDataModelResource, NameSlugPredictedMixin
-from ella_hub.models import Draft, State
-from ella_hub.utils.workflow import set_state, get_state
+from ella_hub.models import Draft, TransitionLog
+from ella_hub.paginator import KeysetPaginator
 from ella_hub.utils import (
     get_content_type_for_resource,
+    get_resource_name_for_content_type,
     get_resource_for_object,
     THUMB_FORMAT,
     get_media_drafts_root,
 )
 from ella_hub.fields import BackportedForeignKey
 from ella_hub.utils.fields import use_in_clever
+from ella_hub.utils.perms import get_permission_matrix
 from ella_hub.validation import ModelValidation
 from ella_hub import conf
 
@@ -375,22 +379,6 @@ class PublishableResource(ExcludeItemsMixin, ApiModelResource):
             bundle.data['app_data'] = current_data
         return bundle
 
-    def _add_state_fields(self, bundle):
-        """Adds current state and next allowed states of object."""
-        state = get_state(bundle.obj)
-        if (((state and state.codename != "published") or not state)
-            and bundle.obj and bundle.obj.published):
-
-            set_state(bundle.obj, "published")
-            state = get_state(bundle.obj)
-
-        if state:
-            bundle.data["state"] = state.codename
-
-        # FIXME: Use correct transition table
-        bundle.data["allowed_states"] = State.objects.get_states_choices_as_dict()
-        return bundle
-
     def build_filters(self, filters=None):
         if filters is None:
             filters = {}
@@ -549,6 +537,64 @@ class DraftResource(ApiModelResource):
         user_fields = ("user",)
 
 
+class TransitionLogResource(ApiModelResource):
+    """
+    Read-only history of state changes, newest first. Pages are
+    requested by ``before`` parameter instead of offset.
+    """
+    user = fields.IntegerField(attribute='user_id', null=True, readonly=True)
+
+    def get_object_list(self, request):
+        return super(TransitionLogResource, self).get_object_list(request).order_by('-id')
+
+    def build_filters(self, filters=None):
+        content_type = None
+        if filters and 'content_type' in filters:
+            content_type = filters['content_type']
+            del filters['content_type']
+
+        orm_filters = super(TransitionLogResource, self).build_filters(filters)
+
+        if content_type:
+            try:
+                orm_filters['content_type'] = get_content_type_for_resource(content_type)
+            except KeyError:
+                raise BadRequest("Unknown resource %s." % content_type)
+
+        return orm_filters
+
+    def dehydrate(self, bundle):
+        states = get_permission_matrix().states
+        from_state = states.get(bundle.obj.from_state_id)
+        to_state = states.get(bundle.obj.to_state_id)
+
+        # same names as accepted by ``content_type`` filter
+        bundle.data['content_type'] = get_resource_name_for_content_type(
+            ContentType.objects.get_for_id(bundle.obj.content_type_id))
+        bundle.data['from_state'] = from_state.codename if from_state else None
+        bundle.data['to_state'] = to_state.codename if to_state else None
+        return bundle
+
+    def _add_states_fields(self, bundle):
+        # log entries have no state
+        bundle['data'] = bundle.pop('objects')
+
+    def _add_state_fields(self, bundle):
+        return bundle
+
+    class Meta(ApiModelResource.Meta):
+        queryset = TransitionLog.objects.all()
+        allowed_methods = ('get',)
+        paginator_class = KeysetPaginator
+        ordering = ()
+        filtering = {
+            'content_type': ('exact',),
+            'content_id': ('exact',),
+            'timestamp': ('gt', 'gte', 'lt', 'lte'),
+        }
+        public = False
+
+
 class ArticleResource(PublishableResource):
     class Meta(PublishableResource.Meta):
         queryset = Article.objects.all()
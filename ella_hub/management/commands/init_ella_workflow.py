@@ -1,12 +1,27 @@
+import json
+from optparse import make_option
+
 from django.core.management import BaseCommand
 
 from ella_hub.api import EllaHubApi
-from ella_hub.utils.workflow import init_ella_workflow
+from ella_hub.utils.workflow import ELLA_WORKFLOW, load_workflow
 
 
 class Command(BaseCommand):
     help = "Init ella workflow"
+    option_list = BaseCommand.option_list + (
+        make_option('--spec', dest='spec', default=None,
+            help='JSON file with workflow specification (default is Ella workflow).'),
+    )
 
     def handle(self, *args, **options):
-        init_ella_workflow(resources=EllaHubApi.collect_resources())
+        spec = ELLA_WORKFLOW
+        if options.get('spec'):
+            with open(options['spec']) as spec_file:
+                spec = json.load(spec_file)
+
+        models = [resource._meta.object_class for resource in EllaHubApi.collect_resources()]
+        workflow, changes = load_workflow(spec, models)
+        for kind, count in changes.items():
+            print '%s: %d created' % (kind, count)
         print 'done'
@@ -0,0 +1,26 @@
+import time
+from optparse import make_option
+
+from django.core.management import BaseCommand
+
+from ella_hub.utils.workflow import process_scheduled_transitions
+
+
+class Command(BaseCommand):
+    help = "Apply due scheduled transitions of objects"
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=None,
+            help='Number of transitions applied in one transaction.'),
+        make_option('--loop', type='int', dest='loop', default=0,
+            help='Keep running and check due transitions every LOOP seconds.'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            applied, failed = process_scheduled_transitions(batch_size=options['batch_size'])
+            if applied or failed or not options['loop']:
+                print '%d transitions applied, %d failed' % (applied, failed)
+
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
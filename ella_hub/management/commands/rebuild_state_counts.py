@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+
+from ella_hub.utils.workflow import rebuild_state_counts
+
+
+class Command(BaseCommand):
+    help = "Rebuild counters of objects in states from state relations"
+
+    def handle(self, *args, **options):
+        count = rebuild_state_counts()
+        print '%d state counters rebuilt' % count
@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+
+from ella_hub.utils.workflow import reconcile_published_states
+
+
+class Command(BaseCommand):
+    help = "Set state published to published publishables in other state"
+
+    def handle(self, *args, **options):
+        count = reconcile_published_states()
+        print '%d publishables fixed' % count
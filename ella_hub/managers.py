@@ -6,6 +6,7 @@ class StateObjectRelationManager(Manager):
     def get_for_ids_as_dict(self, ids, ct):
         """
         Return dict with key as obj_id and val is his state
+        (object has at most one state relation).
         """
         qs = self.select_related('state').filter(content_id__in=ids, content_type=ct)
         return dict((obj.content_id, obj.state) for obj in qs)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def remove_duplicate_states(apps, schema_editor):
+    """Keeps only the last state relation of every object."""
+    StateObjectRelation = apps.get_model('ella_hub', 'StateObjectRelation')
+    duplicates = StateObjectRelation.objects.values('content_type', 'content_id').annotate(
+        last_id=models.Max('id'), relations=models.Count('id')).filter(relations__gt=1)
+    for duplicate in duplicates:
+        StateObjectRelation.objects.filter(
+            content_type=duplicate['content_type'],
+            content_id=duplicate['content_id'],
+        ).exclude(id=duplicate['last_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ella_hub', '0002_auto_20150727_1432'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_states, migrations.RunPython.noop),
+    ]
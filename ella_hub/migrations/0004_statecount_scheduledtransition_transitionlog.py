@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+import django.db.models.deletion
+import ella.core.cache.fields
+import ella_hub.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('ella_hub', '0003_remove_duplicate_states'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='stateobjectrelation',
+            unique_together=set([('content_type', 'content_id')]),
+        ),
+        migrations.CreateModel(
+            name='StateCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('category_key', models.PositiveIntegerField(default=0, verbose_name='Category')),
+                ('count', models.IntegerField(default=0, verbose_name='Count')),
+                ('content_type', ella.core.cache.fields.CachedForeignKey(verbose_name='Content type', to='contenttypes.ContentType')),
+                ('state', ella.core.cache.fields.CachedForeignKey(verbose_name='State', to='ella_hub.State')),
+            ],
+            options={
+                'verbose_name': 'State count',
+                'verbose_name_plural': 'State counts',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='statecount',
+            unique_together=set([('content_type', 'state', 'category_key')]),
+        ),
+        migrations.CreateModel(
+            name='ScheduledTransition',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('content_id', models.PositiveIntegerField(verbose_name='Content id')),
+                ('due', models.DateTimeField(verbose_name='Due', db_index=True)),
+                ('error', models.CharField(max_length=255, verbose_name='Error', blank=True)),
+                ('content_type', ella.core.cache.fields.CachedForeignKey(verbose_name='Content type', to='contenttypes.ContentType')),
+                ('state', ella.core.cache.fields.CachedForeignKey(verbose_name='State', to='ella_hub.State')),
+            ],
+            options={
+                'verbose_name': 'Scheduled transition',
+                'verbose_name_plural': 'Scheduled transitions',
+            },
+        ),
+        migrations.CreateModel(
+            name='TransitionLog',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('content_id', models.PositiveIntegerField(verbose_name='Content id')),
+                ('timestamp', models.DateTimeField(default=ella_hub.utils.timezone.now, verbose_name='Timestamp', db_index=True)),
+                ('content_type', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='Content type', to='contenttypes.ContentType')),
+                ('from_state', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, blank=True, to='ella_hub.State', null=True, verbose_name='From state')),
+                ('to_state', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='To state', to='ella_hub.State')),
+                ('user', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, blank=True, to=settings.AUTH_USER_MODEL, null=True, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Transition log',
+                'verbose_name_plural': 'Transition logs',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='transitionlog',
+            index_together=set([('content_type', 'content_id', 'id')]),
+        ),
+        migrations.CreateModel(
+            name='SignedTokenRevocation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('generation', models.PositiveIntegerField(default=0, verbose_name='Generation')),
+                ('user', models.OneToOneField(verbose_name='User', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Signed token revocation',
+                'verbose_name_plural': 'Signed token revocations',
+            },
+        ),
+    ]
@@ -1,3 +1,6 @@
 from ella_hub.models.main import *
 from ella_hub.models.workflow import *
 from ella_hub.models.permissions import *
+
+# connect signal handlers, AppConfig.ready() isn't called by Django < 1.7
+import ella_hub.signals
@@ -81,3 +81,19 @@ class PublishableLock(models.Model):
         app_label = "ella_hub"
         verbose_name = _("Publishable lock")
         verbose_name_plural = _("Publishable locks")
+
+
+class SignedTokenRevocation(models.Model):
+    """Generation of user's signed tokens, revocation increments it."""
+
+    user = models.OneToOneField(User, verbose_name=_("User"))
+    # compared with generation carried by tokens, so clocks of nodes don't matter
+    generation = models.PositiveIntegerField(_("Generation"), default=0)
+
+    def __unicode__(self):
+        return _("Tokens of '%s' revoked") % self.user.username
+
+    class Meta:
+        app_label = "ella_hub"
+        verbose_name = _("Signed token revocation")
+        verbose_name_plural = _("Signed token revocations")
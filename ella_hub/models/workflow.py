@@ -1,11 +1,12 @@
 from django.db import models
+from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
-from django.core.cache import cache
 
 from ella.core.cache import CachedForeignKey, CachedGenericForeignKey
 from ella_hub.models.permissions import Permission
 from ella_hub.managers import StateObjectRelationManager, StateManager
+from ella_hub.utils.timezone import now
 
 
 class Workflow(models.Model):
@@ -122,11 +123,87 @@ class StateObjectRelation(models.Model):
 
     class Meta:
         app_label = "ella_hub"
-        unique_together = ("content_type", "content_id", "state")
+        unique_together = ("content_type", "content_id")
         verbose_name = _("State-Object Relation")
         verbose_name_plural = _("State-Object Relations")
 
 
+class StateCount(models.Model):
+    """
+    Number of objects of content type in a state (and a category if
+    the model has one), maintained by ``set_state`` and object deletion.
+    """
+
+    # objects without category - NULL can't be used, unique constraint
+    # doesn't consider NULLs equal
+    NO_CATEGORY = 0
+
+    content_type = CachedForeignKey(ContentType, verbose_name=_("Content type"))
+    state = CachedForeignKey(State, verbose_name=_("State"))
+    category_key = models.PositiveIntegerField(_("Category"), default=NO_CATEGORY)
+    count = models.IntegerField(_("Count"), default=0)
+
+    def __unicode__(self):
+        return "%s / %s - %d" % (self.content_type.name, self.state.title, self.count)
+
+    class Meta:
+        app_label = "ella_hub"
+        unique_together = (('content_type', 'state', 'category_key'),)
+        verbose_name = _("State count")
+        verbose_name_plural = _("State counts")
+
+
+class ScheduledTransition(models.Model):
+    """
+    Switch of object to state at due time, applied by
+    ``process_scheduled_transitions`` command. Failed transition
+    is kept with its error and isn't applied again.
+    """
+
+    content_type = CachedForeignKey(ContentType, verbose_name=_("Content type"))
+    content_id = models.PositiveIntegerField(_("Content id"))
+    content_object = CachedGenericForeignKey("content_type", "content_id")
+    state = CachedForeignKey(State, verbose_name=_("State"))
+    due = models.DateTimeField(_("Due"), db_index=True)
+    error = models.CharField(_("Error"), max_length=255, blank=True)
+
+    def __unicode__(self):
+        return "%s %s -> %s (%s)" % (self.content_type.name, self.content_id, self.state.title, self.due)
+
+    class Meta:
+        app_label = "ella_hub"
+        verbose_name = _("Scheduled transition")
+        verbose_name_plural = _("Scheduled transitions")
+
+
+class TransitionLog(models.Model):
+    """
+    Append-only history of state changes of objects. References aren't
+    enforced by database, so the history outlives deleted states and users.
+    """
+
+    content_type = models.ForeignKey(ContentType, verbose_name=_("Content type"),
+        related_name="+", db_constraint=False, on_delete=models.DO_NOTHING)
+    content_id = models.PositiveIntegerField(_("Content id"))
+    from_state = models.ForeignKey(State, verbose_name=_("From state"), blank=True, null=True,
+        related_name="+", db_constraint=False, on_delete=models.DO_NOTHING)
+    to_state = models.ForeignKey(State, verbose_name=_("To state"),
+        related_name="+", db_constraint=False, on_delete=models.DO_NOTHING)
+    user = models.ForeignKey(User, verbose_name=_("User"), blank=True, null=True,
+        related_name="+", db_constraint=False, on_delete=models.DO_NOTHING)
+    timestamp = models.DateTimeField(_("Timestamp"), default=now, db_index=True)
+
+    def __unicode__(self):
+        return "%s %s: %s -> %s" % (self.content_type_id, self.content_id, self.from_state_id, self.to_state_id)
+
+    class Meta:
+        app_label = "ella_hub"
+        # history of object is read by keyset pagination on ID
+        index_together = (("content_type", "content_id", "id"),)
+        verbose_name = _("Transition log")
+        verbose_name_plural = _("Transition logs")
+
+
 class StatePermissionRelation(models.Model):
 
     state = CachedForeignKey("State", verbose_name=_("State"))
@@ -156,15 +233,6 @@ class WorkflowModelRelation(models.Model):
         related_name="wmr_workflow"
     )
 
-    @staticmethod
-    def cache_key(pk):
-        return "HUB_get_workflow_%s" % pk
-
-    def save(self, *args, **kwargs):
-        if self.pk:
-            cache.delete(WorkflowModelRelation.cache_key(self.pk))
-        return super(WorkflowModelRelation, self).save(*args, **kwargs)
-
     def __unicode__(self):
         return "%s / %s" % (self.content_type.name, self.workflow.title)
 
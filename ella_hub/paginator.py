@@ -0,0 +1,60 @@
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+
+class KeysetPaginator(Paginator):
+    """
+    Paginates objects ordered by descending primary key. Next page
+    starts after primary key given by ``before`` parameter instead of
+    offset, so every page is read by index and total count isn't computed.
+    """
+
+    def get_before(self):
+        before = self.request_data.get('before')
+        if before is None:
+            return None
+
+        try:
+            return int(before)
+        except ValueError:
+            raise BadRequest("Invalid before '%s' provided. Please provide an integer." % before)
+
+    def page(self):
+        limit = self.get_limit()
+        before = self.get_before()
+
+        objects = self.objects
+        if before is not None:
+            objects = objects.filter(pk__lt=before)
+
+        # one more object tells if there is next page
+        objects = list(objects[:limit + 1]) if limit else list(objects)
+        next_uri = None
+        if limit and len(objects) > limit:
+            objects = objects[:limit]
+            next_uri = self._generate_keyset_uri(limit, objects[-1].pk)
+
+        return {
+            self.collection_name: objects,
+            'meta': {
+                'limit': limit,
+                'before': before,
+                'next': next_uri,
+            },
+        }
+
+    def _generate_keyset_uri(self, limit, before):
+        if self.resource_uri is None:
+            return None
+
+        request_params = {}
+        for key, value in self.request_data.items():
+            if key not in ('limit', 'before', 'offset'):
+                request_params[key] = value.encode('utf-8') if isinstance(value, unicode) else value
+        request_params.update({'limit': limit, 'before': before})
+        return '%s?%s' % (self.resource_uri, urlencode(sorted(request_params.items())))
@@ -1,29 +1,116 @@
 import re
 import json
 import logging
+from collections import OrderedDict
 
 from django.utils.http import urlunquote_plus
 from django.http import HttpResponseForbidden
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.fields import FieldDoesNotExist
 from django.contrib.contenttypes.models import ContentType
 from django.db.models import Q
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
 from django.template.defaultfilters import slugify
 
-from tastypie.exceptions import NotFound
+from tastypie import fields
+from tastypie.bundle import Bundle
+from tastypie.exceptions import NotFound, ImmediateHttpResponse
 from tastypie.resources import ModelResource
 
-from ella_hub.auth import ApiAuthentication as Authentication
+from ella_hub.auth import get_authentication
 from ella_hub.auth import ApiAuthorization
+from ella_hub.throttle import get_throttle, build_throttled_response
 from ella_hub.utils import get_resource_model
 from ella_hub.utils.perms import has_model_permission, REST_PERMS
-from ella_hub.utils.workflow import set_state, get_state
-from ella_hub.models import StateObjectRelation, State
+from ella_hub.utils.workflow import set_state, get_state, get_states, get_allowed_states
+from ella_hub.models import StateObjectRelation
 from ella_hub.validation import ModelValidation
 
 logger = logging.getLogger(__name__)
 
 
+def get_related_lookups(resource, model, bundle, prefix="", many=False, path=()):
+    """
+    Returns (select_related, prefetch_related) lookups of relations
+    <resource> dehydrates with full=True, nested resources included.
+    Relations under to-many relation have to be prefetched too.
+    """
+    select_related, prefetch_related = [], []
+    for field in resource.fields.values():
+        if not isinstance(field, fields.RelatedField) or not isinstance(field.attribute, basestring):
+            continue
+        if not _is_dehydrated_full(field, bundle):
+            continue
+
+        relation = _resolve_relation(model, field.attribute)
+        if relation is None:
+            continue
+
+        related_model, to_many, prefetchable = relation
+        lookup = prefix + field.attribute
+        if not (many or to_many):
+            select_related.append(lookup)
+        elif prefetchable:
+            prefetch_related.append(lookup)
+        else:
+            # cached foreign keys are read from ella's object cache
+            continue
+
+        related_class = field.to_class
+        if related_class in path:
+            continue
+        nested_select, nested_prefetch = get_related_lookups(related_class(), related_model, bundle,
+            lookup + "__", many or to_many, path + (related_class,))
+        select_related.extend(nested_select)
+        prefetch_related.extend(nested_prefetch)
+
+    return select_related, prefetch_related
+
+
+def _is_dehydrated_full(field, bundle):
+    """
+    Mirrors ``full_dehydrate`` of tastypie. ``ApiModelResource.full_dehydrate``
+    doesn't pass ``for_list``, so all resources are dehydrated as details.
+    """
+    use_in = getattr(field, "use_in", "all")
+    if callable(use_in):
+        if not use_in(bundle):
+            return False
+    elif use_in not in ("all", "detail"):
+        return False
+
+    if callable(field.full_detail):
+        return field.full and field.full_detail(bundle)
+    return field.full and field.full_detail
+
+
+def _resolve_relation(model, attribute):
+    """
+    Returns (related model, True if to-many, True if prefetchable) of relation
+    <attribute> (f.e. "photo__authors") or None if it isn't a model relation.
+    """
+    many = False
+    for name in attribute.split("__"):
+        # descriptors of ella's cached foreign keys can't be read from class,
+        # so Django can't prefetch them
+        prefetchable = getattr(model, name, None) is not None
+        try:
+            field, _, direct, m2m = model._meta.get_field_by_name(name)
+        except FieldDoesNotExist:
+            return None
+
+        if direct:
+            if not getattr(field, "rel", None):
+                return None
+            model = field.rel.to
+            many = many or m2m
+        else:
+            model = field.model
+            many = many or m2m or not field.field.unique
+
+    return model, many, prefetchable
+
+
 class ApiModelResource(ModelResource):
     __GENERATED_FIELDS_CACHE = {}
 
@@ -93,6 +180,56 @@ class ApiModelResource(ModelResource):
 
         return final_fields
 
+    def dispatch(self, request_type, request, **kwargs):
+        request.throttle_type = request_type
+        return super(ApiModelResource, self).dispatch(request_type, request, **kwargs)
+
+    def get_object_list(self, request):
+        object_list = super(ApiModelResource, self).get_object_list(request)
+        if request is None or request.method != "GET":
+            return object_list
+        return self.plan_queryset(object_list, request)
+
+    def plan_queryset(self, object_list, request):
+        """
+        Joins or prefetches relations dehydrated with full=True, so nested
+        resources don't need queries per object.
+        """
+        bundle = Bundle(request=request)
+        select_related, prefetch_related = get_related_lookups(self, object_list.model, bundle,
+            path=(self.__class__,))
+
+        if select_related:
+            object_list = object_list.select_related(*OrderedDict.fromkeys(select_related))
+        if prefetch_related:
+            object_list = object_list.prefetch_related(*OrderedDict.fromkeys(prefetch_related))
+        return object_list
+
+    def get_throttle(self, request):
+        """
+        Returns throttle of request type (``list_throttle``, ...)
+        or default ``throttle`` from resource's Meta.
+        """
+        throttle_type = getattr(request, "throttle_type", None)
+        return getattr(self._meta, "%s_throttle" % throttle_type, self._meta.throttle)
+
+    def throttle_check(self, request):
+        """
+        Overriding throttle_check method because of throttle per request
+        type and Retry-After header in "429 Too Many Requests" response.
+        """
+        identifier = self._meta.authentication.get_identifier(request)
+        throttle = self.get_throttle(request)
+
+        if throttle.should_be_throttled(identifier):
+            raise ImmediateHttpResponse(
+                response=build_throttled_response(throttle, identifier))
+
+    def log_throttled_access(self, request):
+        identifier = self._meta.authentication.get_identifier(request)
+        self.get_throttle(request).accessed(identifier,
+            url=request.get_full_path(), request_method=request.method.lower())
+
     def get_schema(self, request, **kwargs):
         """
         Overriding get_schema method because of altering resource schema
@@ -127,6 +264,7 @@ class ApiModelResource(ModelResource):
         """
         self.method_check(request, allowed=['get'])
         self.is_authenticated(request)
+        request.throttle_type = "list"
         self.throttle_check(request)
 
         # Rip apart the list then iterate.
@@ -162,18 +300,15 @@ class ApiModelResource(ModelResource):
     def _add_states_fields(self, bundle):
         """Adds current state and next allowed states for objects db optimalized."""
         ids_list = [one.obj.pk for one in bundle['objects']]
-        # FIXME: if you have good reason uncomment line below
-        # next_states = State.objects.get_states_choices_as_dict()
         bundle['data'] = []
         if ids_list:
-            ct = ContentType.objects.get_for_model(bundle['objects'][0].obj)
-            sor_dict = StateObjectRelation.objects.get_for_ids_as_dict(ids_list, ct=ct)
+            model = bundle['objects'][0].obj.__class__
+            states = get_states(model, ids_list)
             for obj_bundle in bundle['objects']:
-                state = sor_dict.get(obj_bundle.obj.pk, None)
+                state = states[obj_bundle.obj.pk]
                 if state:
                     obj_bundle.data["state"] = state.codename
-                # FIXME: if you have good reason uncomment line below
-                # obj_bundle.data["allowed_states"] = next_states
+                obj_bundle.data["allowed_states"] = get_allowed_states(model, state)
                 bundle['data'].append(obj_bundle)
         del bundle['objects']
 
@@ -183,8 +318,7 @@ class ApiModelResource(ModelResource):
         if state:
             bundle.data["state"] = state.codename
 
-        # FIXME: Use correct transition table
-        bundle.data["allowed_states"] = State.objects.get_states_choices_as_dict()
+        bundle.data["allowed_states"] = get_allowed_states(bundle.obj, state)
         return bundle
 
     def full_dehydrate(self, bundle, *args, **kwargs):
@@ -258,7 +392,7 @@ class ApiModelResource(ModelResource):
         # so it is not possible to call this in hydrate or full_hydrate
         # because it will not work for new objects
         if "state" in bundle.data:
-            set_state(bundle.obj, bundle.data["state"])
+            set_state(bundle.obj, bundle.data["state"], user=getattr(bundle.request, "user", None))
 
         return bundle
 
@@ -294,34 +428,88 @@ class ApiModelResource(ModelResource):
 
     def build_filters(self, filters=None):
         """Tastypie has too strict validation for filtering."""
-        state = None
-        if filters and "state" in filters:
-            state = filters["state"]
-            del filters["state"]
+        states = []
+        if filters:
+            if "state" in filters:
+                states.append(filters["state"])
+                del filters["state"]
+            if "state__in" in filters:
+                for value in self._get_filter_values(filters, "state__in"):
+                    states.extend(codename for codename in value.split(",") if codename)
+                del filters["state__in"]
 
         filters = super(ApiModelResource, self).build_filters(filters)
 
-        if state:
-            filters["state"] = state
+        if states:
+            filters["state__in"] = states
 
         return filters
 
+    def _get_filter_values(self, filters, name):
+        if hasattr(filters, "getlist"):
+            return filters.getlist(name)
+        return [filters[name]]
+
     def apply_filters(self, request, applicable_filters):
-        # get object IDs of resource type in exact state
-        if "state" in applicable_filters:
+        states = applicable_filters.pop("state__in", None)
+        object_list = super(ApiModelResource, self).apply_filters(request, applicable_filters)
+
+        if states:
+            # subquery is evaluated by database, so the result can be paginated
             content_type = ContentType.objects.get_for_model(self._meta.object_class)
-            state_object_relations = StateObjectRelation.objects.filter(
-                state__codename=applicable_filters["state"], content_type=content_type)
-            object_ids = state_object_relations[:self._meta.limit].values_list("content_id", flat=True)
-            applicable_filters["id__in"] = object_ids
-            del applicable_filters["state"]
+            object_ids = StateObjectRelation.objects.filter(content_type=content_type,
+                state__codename__in=states).values("content_id")
+            object_list = object_list.filter(pk__in=object_ids)
+
+        return object_list
 
-        return super(ApiModelResource, self).apply_filters(request, applicable_filters)
+    def apply_sorting(self, obj_list, options=None):
+        """
+        Adds ordering by virtual field ``state`` (``order_by=state`` or
+        ``order_by=-state``). Objects are ordered by states in order of their
+        creation, objects without state come last.
+        """
+        if not options or not hasattr(options, "getlist"):
+            return super(ApiModelResource, self).apply_sorting(obj_list, options)
+
+        order_by = options.getlist("order_by")
+        if "state" not in order_by and "-state" not in order_by:
+            return super(ApiModelResource, self).apply_sorting(obj_list, options)
+
+        options = options.copy()
+        options.setlist("order_by", [field for field in order_by if field.lstrip("-") != "state"])
+        obj_list = super(ApiModelResource, self).apply_sorting(obj_list, options)
+
+        meta = obj_list.model._meta
+        content_type = ContentType.objects.get_for_model(obj_list.model)
+        state_id = ("SELECT MIN(%(sor)s.state_id) FROM %(sor)s WHERE %(sor)s.content_type_id = %%s "
+            "AND %(sor)s.content_id = %(table)s.%(pk)s") % {
+            "sor": connection.ops.quote_name(StateObjectRelation._meta.db_table),
+            "table": connection.ops.quote_name(meta.db_table),
+            "pk": connection.ops.quote_name(meta.pk.column),
+        }
+        obj_list = obj_list.extra(
+            select={"_state_missing": "(%s) IS NULL" % state_id, "_state_id": state_id},
+            select_params=(content_type.pk, content_type.pk))
+
+        # tastypie translates every other field to exactly one ordering lookup
+        field_ordering = iter(obj_list.query.order_by)
+        ordering = []
+        for field in order_by:
+            if field == "state":
+                ordering.extend(["_state_missing", "_state_id"])
+            elif field == "-state":
+                ordering.extend(["_state_missing", "-_state_id"])
+            else:
+                ordering.append(next(field_ordering))
+        return obj_list.order_by(*ordering)
 
     class Meta:
-        authentication = Authentication()
+        authentication = get_authentication()
         authorization = ApiAuthorization()
         validation = ModelValidation()
+        throttle = get_throttle("default")
+        list_throttle = get_throttle("list")
         always_return_data = True
 
 
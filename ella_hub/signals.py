@@ -1,10 +1,31 @@
+from django.core.signals import request_started, request_finished
+from django.db import DatabaseError, transaction
 from django.db.models import signals
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group, Permission as AuthPermission
+from django.contrib.contenttypes.models import ContentType
 
 from tastypie.models import ApiKey
 
+from ella.core.cache.utils import invalidate_cache_for_object
+
+from ella_hub.models import Role, Permission, ModelPermission, PrincipalRoleRelation, SignedTokenRevocation
+from ella_hub.models import (
+    Workflow,
+    State,
+    Transition,
+    StatePermissionRelation,
+    WorkflowModelRelation,
+    WorkflowPermissionRelation,
+)
+from ella_hub.utils.cache import bump_cache_version
 from ella_hub.utils.timezone import now
 
+# Module is imported by ella_hub.models, so modules importing models
+# may not be initialized yet - their attributes are read in handlers.
+import ella_hub.auth
+import ella_hub.utils.perms
+import ella_hub.utils.workflow
+
 
 def create_api_key(sender, **kwargs):
         """
@@ -13,5 +34,169 @@ def create_api_key(sender, **kwargs):
         if kwargs.get('created') is True:
             ApiKey.objects.create(user=kwargs.get('instance'), created=now())
 
+
+def invalidate_api_key_cache(sender, instance, **kwargs):
+    """
+    Drops cached credentials and pending refresh of changed or removed ``ApiKey``.
+    """
+    ella_hub.auth.pending_refreshes.discard(instance.pk)
+    try:
+        username = instance.user.username
+    except User.DoesNotExist:
+        return
+    ella_hub.auth.invalidate_api_key_info(username, instance.key)
+
+
+def invalidate_user_api_key_cache(sender, instance, **kwargs):
+    """
+    Drops cached credentials and cached object of user, so deactivation
+    and other changes take effect in authentication.
+    """
+    invalidate_cache_for_object(instance)
+    for key in ApiKey.objects.filter(user=instance).values_list('key', flat=True):
+        ella_hub.auth.invalidate_api_key_info(instance.username, key)
+
+
+def invalidate_token_generation_cache(sender, instance, **kwargs):
+    """
+    Drops cached generation of signed tokens of deleted user.
+    """
+    ella_hub.auth.invalidate_token_generation(instance.user_id)
+
+
+def invalidate_permissions_cache(sender, **kwargs):
+    """
+    Invalidates everything cached by roles, permissions and workflows.
+    """
+    if kwargs.get("action", "").startswith("pre_"):
+        return
+    bump_cache_version(ella_hub.utils.perms.PERMISSIONS_VERSION_KEY)
+
+
+def invalidate_workflows_cache(sender, **kwargs):
+    """
+    Invalidates cached workflows of models.
+    """
+    if kwargs.get("action", "").startswith("pre_"):
+        return
+    bump_cache_version(ella_hub.utils.workflow.WORKFLOWS_VERSION_KEY)
+
+
+def invalidate_user_permissions_cache(sender, instance, **kwargs):
+    """
+    Invalidates cached permissions of changed user or of all users
+    if permission or group changes.
+    """
+    if kwargs.get("action", "").startswith("pre_"):
+        return
+    if isinstance(instance, User):
+        ella_hub.utils.perms.invalidate_user_permissions(instance)
+    else:
+        ella_hub.utils.perms.invalidate_user_permissions()
+
+
+def invalidate_user_roles_cache(sender, instance, **kwargs):
+    """
+    Invalidates cached roles of user whose roles or groups changed
+    or of all users if roles of group change.
+    """
+    if kwargs.get("action", "").startswith("pre_"):
+        return
+    if isinstance(instance, PrincipalRoleRelation):
+        if instance.user_id is None:
+            ella_hub.utils.perms.invalidate_user_roles()
+        else:
+            bump_cache_version(ella_hub.utils.perms.get_user_roles_version_key(instance.user_id))
+    elif isinstance(instance, User):
+        ella_hub.utils.perms.invalidate_user_roles(instance)
+    else:
+        ella_hub.utils.perms.invalidate_user_roles()
+
+
+def has_workflow(model):
+    """
+    Returns True if <model> has workflow. Checked in permission matrix,
+    so it doesn't query database.
+    """
+    # models looked up by the check itself
+    if model._meta.app_label in ("contenttypes", "ella_hub"):
+        return False
+    if ella_hub.utils.perms._matrix is None:
+        # first build may run from syncdb/migrate before hub tables exist,
+        # savepoint keeps surrounding transaction usable after the failure
+        try:
+            with transaction.atomic():
+                ella_hub.utils.perms.get_permission_matrix()
+        except DatabaseError:
+            return False
+    content_type = ContentType.objects.get_for_model(model)
+    return content_type.pk in ella_hub.utils.perms.get_permission_matrix().workflows
+
+
+def update_state_count_category(sender, instance, raw=False, **kwargs):
+    """
+    Moves changed object with workflow between state counters of categories.
+    """
+    if not raw and has_workflow(sender):
+        ella_hub.utils.workflow.update_state_category(instance)
+
+
+def remove_object_state(sender, instance, **kwargs):
+    """
+    Removes state of deleted object with workflow and decrements its state counter.
+    """
+    if has_workflow(sender):
+        ella_hub.utils.workflow.remove_state(instance)
+
+
+def start_state_map(sender, **kwargs):
+    ella_hub.utils.workflow.state_map.start()
+
+
+def finish_state_map(sender, **kwargs):
+    ella_hub.utils.workflow.state_map.finish()
+
+
 # generate API key for new user
 signals.post_save.connect(create_api_key, sender=User)
+
+# keep cached API keys in sync with database
+signals.post_save.connect(invalidate_api_key_cache, sender=ApiKey)
+signals.post_delete.connect(invalidate_api_key_cache, sender=ApiKey)
+signals.post_save.connect(invalidate_user_api_key_cache, sender=User)
+signals.post_delete.connect(invalidate_token_generation_cache, sender=SignedTokenRevocation)
+
+# invalidate login responses and other data cached by permissions version
+for model in (Role, Permission, ModelPermission, Workflow, State, Transition, StatePermissionRelation,
+              WorkflowModelRelation, WorkflowPermissionRelation):
+    signals.post_save.connect(invalidate_permissions_cache, sender=model)
+    signals.post_delete.connect(invalidate_permissions_cache, sender=model)
+signals.m2m_changed.connect(invalidate_permissions_cache, sender=State.transitions.through)
+
+# invalidate cached workflows of models
+for model in (Workflow, WorkflowModelRelation, State, Transition):
+    signals.post_save.connect(invalidate_workflows_cache, sender=model)
+    signals.post_delete.connect(invalidate_workflows_cache, sender=model)
+signals.m2m_changed.connect(invalidate_workflows_cache, sender=State.transitions.through)
+
+# invalidate cached django.contrib.auth permissions of users
+signals.post_save.connect(invalidate_user_permissions_cache, sender=User)
+signals.post_delete.connect(invalidate_user_permissions_cache, sender=Group)
+signals.post_delete.connect(invalidate_user_permissions_cache, sender=AuthPermission)
+signals.m2m_changed.connect(invalidate_user_permissions_cache, sender=User.user_permissions.through)
+signals.m2m_changed.connect(invalidate_user_permissions_cache, sender=User.groups.through)
+signals.m2m_changed.connect(invalidate_user_permissions_cache, sender=Group.permissions.through)
+
+# invalidate cached effective roles of users
+signals.post_save.connect(invalidate_user_roles_cache, sender=PrincipalRoleRelation)
+signals.post_delete.connect(invalidate_user_roles_cache, sender=PrincipalRoleRelation)
+signals.post_delete.connect(invalidate_user_roles_cache, sender=Group)
+signals.m2m_changed.connect(invalidate_user_roles_cache, sender=User.groups.through)
+
+# keep states of objects with workflow in sync with objects
+signals.pre_save.connect(update_state_count_category)
+signals.post_delete.connect(remove_object_state)
+
+# states of objects are remembered during request
+request_started.connect(start_state_map)
+request_finished.connect(finish_state_map)
@@ -0,0 +1,137 @@
+import math
+import time
+
+from django.core.cache import cache
+
+from tastypie.http import HttpTooManyRequests
+from tastypie.throttle import BaseThrottle
+
+from ella_hub import conf
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    """
+    Sliding window counter stored in the Django cache. Requests are counted
+    in windows of ``timeframe`` seconds, count of the previous window is
+    weighted by its part still covered by the sliding window. Clients can burst
+    up to ``throttle_at`` requests and then continue at steady rate
+    ``throttle_at / timeframe`` requests per second.
+
+    Counters are changed only by atomic ``cache.add``/``incr``/``decr``, so
+    concurrent requests can't exceed the budget. Request takes its slot
+    in ``should_be_throttled``, ``accessed`` doesn't count it again.
+
+    Windows of different scopes (login, list, ...) are independent.
+    """
+
+    def __init__(self, throttle_at=150, timeframe=3600, expiration=None, scope="default"):
+        if expiration is None:
+            # counter is needed in its window and the following one
+            expiration = 2 * timeframe
+
+        super(SlidingWindowThrottle, self).__init__(throttle_at, timeframe, expiration)
+        self.scope = scope
+
+    def convert_identifier_to_key(self, identifier):
+        key = super(SlidingWindowThrottle, self).convert_identifier_to_key(identifier)
+        return "HUB_throttle_%s_%s" % (self.scope, key)
+
+    def get_window_key(self, identifier, window):
+        return "%s_%d" % (self.convert_identifier_to_key(identifier), window)
+
+    def get_counts(self, identifier):
+        """
+        Returns tuple (previous window count, current window count,
+        seconds elapsed in current window) for <identifier>.
+        """
+        window, elapsed = divmod(time.time(), self.timeframe)
+        counts = cache.get_many([self.get_window_key(identifier, window - 1),
+            self.get_window_key(identifier, window)])
+        return (counts.get(self.get_window_key(identifier, window - 1), 0),
+            counts.get(self.get_window_key(identifier, window), 0),
+            elapsed)
+
+    def should_be_throttled(self, identifier, **kwargs):
+        window, elapsed = divmod(time.time(), self.timeframe)
+        key = self.get_window_key(identifier, window)
+
+        cache.add(key, 0, timeout=self.expiration)
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # counter expired or was evicted in the meantime
+            cache.add(key, 1, timeout=self.expiration)
+            count = 1
+
+        previous = cache.get(self.get_window_key(identifier, window - 1), 0)
+        if previous * (1 - elapsed / self.timeframe) + count <= self.throttle_at:
+            return False
+
+        # throttled request doesn't use the budget
+        try:
+            cache.decr(key)
+        except ValueError:
+            pass
+        return True
+
+    def accessed(self, identifier, **kwargs):
+        # request was counted by should_be_throttled
+        pass
+
+    def get_retry_after(self, identifier):
+        """
+        Returns number of seconds until next request of <identifier>
+        is allowed.
+        """
+        previous, count, elapsed = self.get_counts(identifier)
+        if count + 1 > self.throttle_at:
+            # current window becomes previous one
+            elapsed, previous, count = elapsed - self.timeframe, count, 0
+
+        # wait until weighted previous count drops enough
+        allowed_at = 0
+        if previous:
+            allowed_at = self.timeframe - float(self.throttle_at - 1 - count) * self.timeframe / previous
+        return max(1, int(math.ceil(allowed_at - elapsed)))
+
+
+def get_throttle(scope):
+    """
+    Returns throttle for <scope> configured by ``ELLA_HUB_THROTTLE_RATES``.
+    Scopes without configured rate aren't throttled.
+    """
+    rate = conf.THROTTLE_RATES.get(scope)
+    if rate is None:
+        return BaseThrottle()
+
+    throttle_at, timeframe = rate
+    return SlidingWindowThrottle(throttle_at, timeframe, scope=scope)
+
+
+def get_client_identifier(request):
+    """
+    Returns identifier of client sending <request> configured by
+    ``ELLA_HUB_THROTTLE_CLIENT_IDENTIFIER`` - key of ``request.META``
+    or callable taking the request.
+    """
+    identifier = conf.THROTTLE_CLIENT_IDENTIFIER
+    if callable(identifier):
+        return identifier(request)
+
+    # proxy appends address of its client to the end of forwarded header
+    address = request.META.get(identifier, "").split(",")[-1].strip()
+    return address or "noaddr"
+
+
+def build_throttled_response(throttle, identifier):
+    """
+    Returns "429 Too Many Requests" response with Retry-After header.
+    """
+    if isinstance(throttle, SlidingWindowThrottle):
+        retry_after = throttle.get_retry_after(identifier)
+    else:
+        retry_after = throttle.timeframe
+
+    response = HttpTooManyRequests()
+    response["Retry-After"] = str(retry_after)
+    return response
@@ -40,6 +40,16 @@ def get_content_type_for_resource(resource_name):
     return ContentType.objects.get_for_model(resource._meta.object_class)
 
 
+def get_resource_name_for_content_type(content_type):
+    """
+    Returns name of resource of given content type (reverse of
+    `get_content_type_for_resource`) or `None` if resource is not found.
+    """
+    for resource_name, resource in __REGISTERED_RESOURCES.items():
+        if ContentType.objects.get_for_model(resource._meta.object_class).pk == content_type.pk:
+            return resource_name
+
+
 def get_resource_model(resource_name):
     """Returns DB model for give resource name."""
     resource = __REGISTERED_RESOURCES[resource_name]
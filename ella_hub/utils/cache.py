@@ -0,0 +1,200 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+from ella_hub import conf
+
+
+class LocalCache(object):
+    """
+    Process-local LRU cache with per-entry expiration.
+
+    Used as the first tier in front of the shared Django cache, other
+    processes can't invalidate its entries, so they have to expire quickly
+    or be checked against a version in the shared cache.
+    """
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+
+            if expires <= time.time():
+                return default
+
+            # re-insert so the most recently used key goes last
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + timeout, value)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# versions read by this process, bumped versions are dropped immediately
+local_versions = LocalCache(1000, conf.STATES_LOCAL_CACHE_TIMEOUT)
+
+
+def get_initial_version():
+    return int(time.time() * 1000000)
+
+
+def get_cache_version(key, local=False):
+    """
+    Returns version stored in the shared cache under <key>. Versions start
+    at current time in microseconds, so evicted counter doesn't revive
+    outdated entries even if it was bumped many times per second.
+
+    If <local> is True, version may be up to ``STATES_LOCAL_CACHE_TIMEOUT``
+    seconds old when it was bumped by another process.
+    """
+    if local:
+        version = local_versions.get(key)
+        if version is None:
+            version = get_cache_version(key)
+            local_versions.set(key, version)
+        return version
+
+    version = cache.get(key)
+    if version is None:
+        version = get_initial_version()
+        cache.add(key, version, timeout=None)
+        version = cache.get(key, version)
+    return version
+
+
+def bump_cache_version(key):
+    """
+    Invalidates all entries keyed by version stored under <key>.
+    """
+    local_versions.delete(key)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = get_initial_version()
+        cache.set(key, version, timeout=None)
+        return version
+
+
+class VersionedCache(object):
+    """
+    Two-tier cache of computed values invalidated by bumping version
+    stored under <version_key>.
+
+    Entries of the shared tier are kept <stale_timeout> seconds after
+    they expire. Expired or missing entry is recomputed by the worker which
+    acquires lock in the shared cache, other workers serve the stale value
+    meanwhile. Missing entry has nothing to serve, so they poll the shared
+    cache every <poll_interval> seconds and compute the value themselves
+    only if it doesn't appear in <wait_timeout> seconds.
+    """
+
+    _missing = object()
+
+    def __init__(self, prefix, version_key, timeout, local_timeout, local_size,
+                 stale_timeout=None, lock_timeout=30, wait_timeout=5, poll_interval=0.05):
+        self.prefix = prefix
+        self.version_key = version_key
+        self.timeout = timeout
+        self.stale_timeout = timeout if stale_timeout is None else stale_timeout
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.local = LocalCache(local_size, local_timeout)
+
+    def make_key(self, key, version):
+        return "%s_%s_%s" % (self.prefix, version, key)
+
+    def get_or_set(self, key, compute):
+        """
+        Returns value cached under <key> or computes it by <compute>
+        function. Value can't be None.
+        """
+        version = get_cache_version(self.version_key, local=True)
+        shared_key = self.make_key(key, version)
+
+        value = self.local.get(shared_key, self._missing)
+        if value is not self._missing:
+            return value
+
+        entry = cache.get(shared_key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.time():
+                self.local.set(shared_key, value)
+                return value
+
+        locked = self._acquire(shared_key)
+        if not locked:
+            if entry is None:
+                entry = self._wait(shared_key)
+            if entry is not None:
+                value = entry[1]
+                self.local.set(shared_key, value)
+                return value
+
+        try:
+            value = compute()
+            self.local.set(shared_key, value)
+            cache.set(shared_key, (time.time() + self.timeout, value),
+                timeout=self.timeout + self.stale_timeout)
+        finally:
+            if locked:
+                cache.delete(self._lock_key(shared_key))
+        return value
+
+    def invalidate(self):
+        """
+        Invalidates all entries, in other processes the local tier
+        expires in its timeout.
+        """
+        self.local.clear()
+        bump_cache_version(self.version_key)
+
+    def _lock_key(self, shared_key):
+        return "%s_lock" % shared_key
+
+    def _acquire(self, shared_key):
+        return cache.add(self._lock_key(shared_key), 1, timeout=self.lock_timeout)
+
+    def _wait(self, shared_key):
+        """
+        Waits for entry computed by the worker holding the lock,
+        returns None if it doesn't appear in time.
+        """
+        deadline = time.time() + self.wait_timeout
+        while time.time() < deadline:
+            time.sleep(self.poll_interval)
+            entry = cache.get(shared_key)
+            if entry is not None:
+                return entry
+        return None
@@ -1,9 +1,29 @@
+import operator
+import threading
+
+from collections import defaultdict
+
+from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
 from ella.core.cache import get_cached_object
 
-from ella_hub.models import Permission, ModelPermission, PrincipalRoleRelation
+from ella_hub import conf
+from ella_hub.models import Permission, ModelPermission, PrincipalRoleRelation, Role
+from ella_hub.models import State, Workflow, WorkflowModelRelation, StatePermissionRelation
+from ella_hub.models import StateObjectRelation
+from ella_hub.utils.cache import get_cache_version, bump_cache_version
+
 
+# version of roles, permissions and workflows bumped on every change
+PERMISSIONS_VERSION_KEY = "HUB_permissions_version"
+# version of django.contrib.auth permissions of all users
+USER_PERMISSIONS_VERSION_KEY = "HUB_user_permissions_version"
+# version of roles of all users, bumped when roles of groups change
+USER_ROLES_VERSION_KEY = "HUB_user_roles_version"
 
 REST_PERMS = {
     "GET": "change",
@@ -14,6 +34,225 @@ REST_PERMS = {
 }
 
 
+class PermissionMatrix(object):
+    """
+    Compiled (role, content type, permission, state) relations of all roles
+    and transitions of all workflows.
+
+    Every role has its bit, so set of roles is an integer mask and each
+    (content type, permission) and (state, permission) pair maps to mask
+    of roles it is granted to. Permission checks are then only dictionary
+    lookups and bitwise operations.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.role_bits = {}
+        self.all_roles_mask = 0
+        # codename -> (id, restriction)
+        self.permissions = {}
+        # (content type id, permission id) -> mask of roles
+        self.model_masks = defaultdict(int)
+        # (state id, permission id) -> mask of roles
+        self.state_masks = defaultdict(int)
+        # permission id -> [(state id, mask of roles), ...]
+        self.permission_states = defaultdict(list)
+        self.states = {}
+        # content type id -> workflow id
+        self.workflows = {}
+        # workflow id -> initial state id
+        self.initial_states = {}
+        # state id -> ids of destination states of its transitions
+        self.destinations = defaultdict(set)
+        self._init_states = {}
+        self._allowed_states = {}
+
+    def build(self):
+        for i, role_id in enumerate(Role.objects.order_by('pk').values_list('pk', flat=True)):
+            self.role_bits[role_id] = 1 << i
+            self.all_roles_mask |= 1 << i
+
+        for pk, codename, restriction in Permission.objects.values_list('pk', 'codename', 'restriction'):
+            self.permissions[codename] = (pk, restriction)
+
+        relations = ModelPermission.objects.exclude(role=None).values_list(
+            'role_id', 'content_type_id', 'permission_id')
+        for role_id, ct_id, perm_id in relations:
+            self.model_masks[(ct_id, perm_id)] |= self.role_bits.get(role_id, 0)
+
+        relations = StatePermissionRelation.objects.values_list('state_id', 'permission_id', 'role_id')
+        for state_id, perm_id, role_id in relations:
+            self.state_masks[(state_id, perm_id)] |= self.role_bits.get(role_id, 0)
+        for (state_id, perm_id), mask in self.state_masks.items():
+            self.permission_states[perm_id].append((state_id, mask))
+
+        self.states = dict((state.pk, state) for state in State.objects.all())
+        self.workflows = dict(WorkflowModelRelation.objects.values_list('content_type_id', 'workflow_id'))
+        self.initial_states = dict(Workflow.objects.values_list('pk', 'initial_state_id'))
+
+        transitions = State.transitions.through.objects.values_list('state_id', 'transition__destination_id')
+        for state_id, destination_id in transitions:
+            self.destinations[state_id].add(destination_id)
+
+        return self
+
+    def get_roles_mask(self, role_ids):
+        mask = 0
+        for role_id in role_ids:
+            mask |= self.role_bits.get(role_id, 0)
+        return mask
+
+    def get_role_ids(self, mask):
+        return [role_id for role_id, bit in self.role_bits.items() if bit & mask]
+
+    def get_user_mask(self, user):
+        if user.is_superuser:
+            return self.all_roles_mask
+        return self.get_roles_mask(get_effective_role_ids(user))
+
+    def has_permission(self, mask, content_type_id, permission_id, state_id=None):
+        """
+        Returns True if some role of <mask> has permission for content type
+        (and for <state_id> if specified).
+        """
+        if not self.model_masks.get((content_type_id, permission_id), 0) & mask:
+            return False
+        if state_id is None:
+            return True
+        return bool(self.state_masks.get((state_id, permission_id), 0) & mask)
+
+    def get_permitted_state_ids(self, codename, mask):
+        """
+        Returns IDs of states in which roles of <mask> have permission <codename>.
+        """
+        perm_id = self.permissions.get(codename, (None, None))[0]
+        return [state_id for state_id, state_mask in self.permission_states.get(perm_id, ())
+            if state_mask & mask]
+
+    def get_init_states(self, content_type_id, mask, workflow_id=None):
+        """
+        Returns states roles of <mask> have permissions for. If <workflow_id>
+        is specified, only states reachable from its initial state are returned.
+        """
+        key = (content_type_id, mask, workflow_id)
+        if key not in self._init_states:
+            state_ids = set()
+            for (ct_id, perm_id), model_mask in self.model_masks.items():
+                if ct_id != content_type_id or not model_mask & mask:
+                    continue
+                for state_id, state_mask in self.permission_states.get(perm_id, ()):
+                    if state_mask & mask:
+                        state_ids.add(state_id)
+
+            initial_state_id = self.initial_states.get(workflow_id)
+            if initial_state_id is not None:
+                state_ids &= self.destinations[initial_state_id]
+
+            self._init_states[key] = [self.states[pk] for pk in sorted(state_ids) if pk in self.states]
+
+        return self._init_states[key]
+
+    def get_allowed_states(self, content_type_id, state_id=None):
+        """
+        Returns {codename: title} of states object of content type in state
+        <state_id> can be switched to. Object without state can be switched
+        to initial state of its workflow and to states reachable from it.
+        """
+        key = (content_type_id, state_id)
+        if key not in self._allowed_states:
+            if state_id is None:
+                state_id = self.initial_states.get(self.workflows.get(content_type_id))
+                state_ids = set([state_id]) if state_id is not None else set()
+            else:
+                state_ids = set()
+            if state_id is not None:
+                state_ids |= self.destinations.get(state_id, set())
+
+            self._allowed_states[key] = dict(
+                (self.states[pk].codename, self.states[pk].title)
+                for pk in state_ids if pk in self.states
+            )
+
+        return self._allowed_states[key]
+
+
+_matrix = None
+_matrix_lock = threading.Lock()
+
+
+def get_permission_matrix():
+    """
+    Returns process-wide `PermissionMatrix`, it's rebuilt when
+    roles, permissions or workflows change.
+    """
+    global _matrix
+
+    version = get_cache_version(PERMISSIONS_VERSION_KEY, local=True)
+    matrix = _matrix
+    if matrix is None or matrix.version != version:
+        with _matrix_lock:
+            if _matrix is None or _matrix.version != version:
+                _matrix = PermissionMatrix(version).build()
+            matrix = _matrix
+    return matrix
+
+
+def get_user_roles_version_key(user_id):
+    return "%s_%s" % (USER_ROLES_VERSION_KEY, user_id)
+
+
+def invalidate_after_bulk(*version_keys):
+    """
+    Bumps cache versions <version_keys> after bulk inserts and updates.
+    Caches are invalidated by model signals, which ``bulk_create``
+    and ``QuerySet.update`` don't send, so bulk helpers call this instead.
+    """
+    for version_key in version_keys:
+        bump_cache_version(version_key)
+
+
+def invalidate_user_roles(user=None):
+    """
+    Invalidates cached roles of <user> or of all users
+    if <user> is not specified (roles of group changed).
+    """
+    if user is None:
+        bump_cache_version(USER_ROLES_VERSION_KEY)
+    else:
+        _forget_user_roles(user)
+        bump_cache_version(get_user_roles_version_key(user.pk))
+
+
+def get_effective_role_ids(user):
+    """
+    Returns IDs of roles of <user> including roles of user's groups.
+    They are cached until roles of the user or of groups change
+    and kept on the user object for the rest of the request.
+    """
+    if not hasattr(user, '_hub_role_ids'):
+        cache_key = "HUB_user_roles_%s_%s_%s" % (
+            user.pk,
+            get_cache_version(USER_ROLES_VERSION_KEY),
+            get_cache_version(get_user_roles_version_key(user.pk)),
+        )
+        role_ids = cache.get(cache_key)
+
+        if role_ids is None:
+            role_ids = frozenset(PrincipalRoleRelation.objects.filter(
+                Q(user=user) | Q(group__user=user),
+                content_type=None,
+                content_id=None
+            ).values_list('role_id', flat=True))
+            cache.set(cache_key, role_ids, timeout=conf.USER_PERMISSIONS_CACHE_TIMEOUT)
+
+        user._hub_role_ids = role_ids
+    return user._hub_role_ids
+
+
+def _forget_user_roles(user):
+    user.__dict__.pop('_hub_role_ids', None)
+
+
 def has_model_permission(model, user, permission):
     """
     Uses only standard django model permissions
@@ -23,12 +262,104 @@ def has_model_permission(model, user, permission):
     return user.has_perm("%s.%s_%s" % (ct.app_label, permission, ct.model))
 
 
-def has_object_permission(model_obj, user, codename):
+def has_model_state_permission(model, user, codename, state=None):
+    """
+    Returns True if some role of <user> has permission <codename> for <model>
+    (in <state> if specified). Superusers have all permissions except restrictions.
+    """
+    if not user.is_active:
+        return False
+
+    matrix = get_permission_matrix()
+    try:
+        permission_id, restriction = matrix.permissions[codename]
+    except KeyError:
+        return False
+
+    if user.is_superuser:
+        return not restriction
+
+    content_type = ContentType.objects.get_for_model(model)
+    return matrix.has_permission(matrix.get_user_mask(user), content_type.pk,
+        permission_id, state.pk if state is not None else None)
+
+
+def get_object_role_relations(user, model, codename):
+    """
+    Returns query of object-scoped roles (``PrincipalRoleRelation`` bound
+    to object) of <user> or of user's groups which grant permission <codename>
+    for <model> objects, None if no role can grant it. Objects of model
+    with workflow are granted permissions the role has in their current
+    state (objects without state in initial state of the workflow), objects
+    of other models permissions the role has for the model.
+    """
+    if not user.is_active:
+        return None
+
+    matrix = get_permission_matrix()
+    try:
+        permission_id, restriction = matrix.permissions[codename]
+    except KeyError:
+        return None
+
+    content_type = ContentType.objects.get_for_model(model)
+    relations = PrincipalRoleRelation.objects.filter(
+        Q(user=user) | Q(group__user=user),
+        content_type=content_type
+    )
+
+    if content_type.pk not in matrix.workflows:
+        role_ids = matrix.get_role_ids(matrix.model_masks.get((content_type.pk, permission_id), 0))
+        if not role_ids:
+            return None
+        return relations.filter(role__in=role_ids)
+
+    state_ids = defaultdict(list)
+    for state_id, mask in matrix.permission_states.get(permission_id, ()):
+        for role_id in matrix.get_role_ids(mask):
+            state_ids[role_id].append(state_id)
+    if not state_ids:
+        return None
+
+    states = StateObjectRelation.objects.filter(content_type=content_type)
+    initial_state_id = matrix.initial_states.get(matrix.workflows[content_type.pk])
+    granted = []
+    for role_id, role_state_ids in state_ids.items():
+        in_states = Q(content_id__in=states.filter(state__in=role_state_ids).values('content_id'))
+        if initial_state_id in role_state_ids:
+            in_states |= ~Q(content_id__in=states.values('content_id'))
+        granted.append(Q(role=role_id) & in_states)
+
+    return relations.filter(reduce(operator.or_, granted))
+
+
+def get_permitted_object_ids(user, model, codename, ids=None):
     """
-    Fallback
+    Returns IDs of <model> objects <user> has permission <codename> for
+    through object-scoped roles (see ``get_object_role_relations``).
+    Candidates can be limited to <ids> (f.e. objects of one page),
+    all of them are resolved by one query.
     """
+    relations = get_object_role_relations(user, model, codename)
+    if relations is None:
+        return set()
 
-    return has_model_permission(model_obj, user, codename)
+    if ids is not None:
+        relations = relations.filter(content_id__in=list(ids))
+    return set(relations.values_list('content_id', flat=True))
+
+
+def has_object_permission(model_obj, user, permission, codename=None):
+    """
+    Checks django model <permission> (``change``, ``delete``, ...) of <user>,
+    then workflow permission <codename> (``can_view``, ...) granted
+    by object-scoped roles if specified.
+    """
+    if has_model_permission(model_obj, user, permission):
+        return True
+    if codename is None or model_obj.pk is None:
+        return False
+    return model_obj.pk in get_permitted_object_ids(user, model_obj.__class__, codename, [model_obj.pk])
 
 
 def grant_permission(model, role, permission):
@@ -55,6 +386,7 @@ def grant_permission(model, role, permission):
 def add_role(principal, role):
     "Adds <role> to user or group (<principal>)."
     if isinstance(principal, User):
+        _forget_user_roles(principal)
         try:
             PrincipalRoleRelation.objects.get(
                 user=principal,
@@ -82,6 +414,7 @@ def remove_role(principal, role):
     "Removes specific <role> from user or group (<principal>)."
     try:
         if isinstance(principal, User):
+            _forget_user_roles(principal)
             relation = PrincipalRoleRelation.objects.get(
                 user=principal,
                 role=role,
@@ -102,9 +435,43 @@ def remove_role(principal, role):
     return True
 
 
+def add_object_role(principal, role, obj):
+    "Adds <role> to user or group (<principal>) only for object <obj>."
+    relation, created = PrincipalRoleRelation.objects.get_or_create(
+        role=role,
+        content_type=ContentType.objects.get_for_model(obj),
+        content_id=obj.pk,
+        **_get_principal_kwargs(principal)
+    )
+    return created
+
+
+def remove_object_role(principal, role, obj):
+    "Removes <role> of user or group (<principal>) for object <obj>."
+    relations = PrincipalRoleRelation.objects.filter(
+        role=role,
+        content_type=ContentType.objects.get_for_model(obj),
+        content_id=obj.pk,
+        **_get_principal_kwargs(principal)
+    )
+    if relations:
+        relations.delete()
+        return True
+    else:
+        return False
+
+
+def _get_principal_kwargs(principal):
+    if isinstance(principal, User):
+        return {'user': principal}
+    else:
+        return {'group': principal}
+
+
 def remove_roles(principal):
     "Removes all roles from user or group (<principal>)."
     if isinstance(principal, User):
+        _forget_user_roles(principal)
         relations = PrincipalRoleRelation.objects.filter(
             user=principal,
             content_id=None,
@@ -123,6 +490,155 @@ def remove_roles(principal):
         return False
 
 
+def _get_model_permission_keys(items):
+    """
+    Returns set of (role ID, content type ID, permission ID) for
+    (model, role, permission) <items>, unknown codenames are skipped.
+    """
+    items = list(items)
+    codenames = [p for _, _, p in items if not isinstance(p, Permission)]
+    permission_ids = {}
+    if codenames:
+        permission_ids = dict(Permission.objects.filter(
+            codename__in=set(codenames)).values_list('codename', 'pk'))
+
+    keys = set()
+    for model, role, permission in items:
+        if isinstance(permission, Permission):
+            permission_id = permission.pk
+        else:
+            permission_id = permission_ids.get(permission)
+            if permission_id is None:
+                continue
+        ct = ContentType.objects.get_for_model(model)
+        keys.add((role.pk, ct.pk, permission_id))
+    return keys
+
+
+def _get_existing_model_permissions(keys):
+    "Returns {(role ID, content type ID, permission ID): pk} of existing <keys>."
+    relations = ModelPermission.objects.filter(
+        role__in=set(k[0] for k in keys),
+        content_type__in=set(k[1] for k in keys),
+        permission__in=set(k[2] for k in keys)
+    ).values_list('pk', 'role_id', 'content_type_id', 'permission_id')
+    existing = {}
+    for pk, role_id, ct_id, permission_id in relations:
+        if (role_id, ct_id, permission_id) in keys:
+            existing[(role_id, ct_id, permission_id)] = pk
+    return existing
+
+
+def bulk_grant_permissions(items):
+    """
+    Grants permissions of (model, role, permission) <items>, permission
+    can be codename or Permission object. Returns number of granted permissions.
+    """
+    keys = _get_model_permission_keys(items)
+    if not keys:
+        return 0
+
+    with transaction.atomic():
+        existing = _get_existing_model_permissions(keys)
+        relations = [
+            ModelPermission(role_id=role_id, content_type_id=ct_id, permission_id=permission_id)
+            for (role_id, ct_id, permission_id) in keys
+            if (role_id, ct_id, permission_id) not in existing
+        ]
+        ModelPermission.objects.bulk_create(relations)
+
+    if relations:
+        invalidate_after_bulk(PERMISSIONS_VERSION_KEY)
+    return len(relations)
+
+
+def bulk_revoke_permissions(items):
+    """
+    Revokes permissions of (model, role, permission) <items>.
+    Returns number of revoked permissions.
+    """
+    keys = _get_model_permission_keys(items)
+    if not keys:
+        return 0
+
+    with transaction.atomic():
+        existing = _get_existing_model_permissions(keys)
+        if existing:
+            ModelPermission.objects.filter(pk__in=existing.values()).delete()
+    return len(existing)
+
+
+def _get_principal_role_keys(items):
+    "Returns set of (user ID, group ID, role ID) for (principal, role) <items>."
+    keys = set()
+    for principal, role in items:
+        if isinstance(principal, User):
+            _forget_user_roles(principal)
+            keys.add((principal.pk, None, role.pk))
+        else:
+            keys.add((None, principal.pk, role.pk))
+    return keys
+
+
+def _get_existing_principal_roles(keys):
+    "Returns {(user ID, group ID, role ID): pk} of existing <keys>."
+    user_ids = set(k[0] for k in keys if k[0] is not None)
+    group_ids = set(k[1] for k in keys if k[1] is not None)
+    relations = PrincipalRoleRelation.objects.filter(
+        Q(user__in=user_ids) | Q(group__in=group_ids),
+        role__in=set(k[2] for k in keys),
+        content_type=None,
+        content_id=None
+    ).values_list('pk', 'user_id', 'group_id', 'role_id')
+    existing = {}
+    for pk, user_id, group_id, role_id in relations:
+        key = (user_id, None, role_id) if user_id is not None else (None, group_id, role_id)
+        if key in keys:
+            existing[key] = pk
+    return existing
+
+
+def bulk_add_roles(items):
+    """
+    Adds roles to users or groups of (principal, role) <items>.
+    Returns number of added roles.
+    """
+    keys = _get_principal_role_keys(items)
+    if not keys:
+        return 0
+
+    with transaction.atomic():
+        existing = _get_existing_principal_roles(keys)
+        relations = [
+            PrincipalRoleRelation(user_id=user_id, group_id=group_id, role_id=role_id)
+            for (user_id, group_id, role_id) in keys
+            if (user_id, group_id, role_id) not in existing
+        ]
+        PrincipalRoleRelation.objects.bulk_create(relations)
+
+    version_keys = set(get_user_roles_version_key(r.user_id) for r in relations if r.user_id is not None)
+    if any(r.group_id is not None for r in relations):
+        version_keys.add(USER_ROLES_VERSION_KEY)
+    invalidate_after_bulk(*version_keys)
+    return len(relations)
+
+
+def bulk_remove_roles(items):
+    """
+    Removes roles from users or groups of (principal, role) <items>.
+    Returns number of removed roles.
+    """
+    keys = _get_principal_role_keys(items)
+    if not keys:
+        return 0
+
+    with transaction.atomic():
+        existing = _get_existing_principal_roles(keys)
+        if existing:
+            PrincipalRoleRelation.objects.filter(pk__in=existing.values()).delete()
+    return len(existing)
+
+
 def get_roles(principal):
     "Returns all roles of user or group (<principal>)."
     if isinstance(principal, User):
@@ -132,3 +648,51 @@ def get_roles(principal):
     relations = PrincipalRoleRelation.objects.filter(**kwargs).select_related('role')
     roles = [relation.role for relation in relations]
     return roles
+
+
+def get_role_signature(user):
+    """
+    Returns string identifying set of roles of <user>. Users with
+    the same signature have the same permissions.
+    """
+    if user.is_superuser:
+        return "superuser"
+
+    return ",".join(str(pk) for pk in sorted(get_effective_role_ids(user)))
+
+
+def get_user_permissions_version_key(user_id):
+    return "%s_%s" % (USER_PERMISSIONS_VERSION_KEY, user_id)
+
+
+def invalidate_user_permissions(user=None):
+    """
+    Invalidates cached django.contrib.auth permissions of <user>
+    or of all users if <user> is not specified.
+    """
+    if user is None:
+        bump_cache_version(USER_PERMISSIONS_VERSION_KEY)
+    else:
+        bump_cache_version(get_user_permissions_version_key(user.pk))
+
+
+def load_user_permissions(user):
+    """
+    Fills permission cache of <user> used by `ModelBackend.has_perm`
+    from the shared cache, so permission checks don't hit database.
+    """
+    if user.is_superuser or not user.is_active:
+        return
+
+    cache_key = "HUB_user_permissions_%s_%s_%s" % (
+        user.pk,
+        get_cache_version(USER_PERMISSIONS_VERSION_KEY),
+        get_cache_version(get_user_permissions_version_key(user.pk)),
+    )
+    perms = cache.get(cache_key)
+
+    if perms is None:
+        perms = ModelBackend().get_all_permissions(user)
+        cache.set(cache_key, perms, timeout=conf.USER_PERMISSIONS_CACHE_TIMEOUT)
+
+    user._perm_cache = perms
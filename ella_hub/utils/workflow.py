@@ -1,332 +1,883 @@
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+
 from django.contrib.contenttypes.models import ContentType
-from django.core.cache import cache
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Count, F, Sum
+from django.db.models.fields import FieldDoesNotExist
 from django.utils.translation import ugettext_lazy as _
 
-from ella.articles.models import Article
 from ella.core.cache import get_cached_object
+from ella.core.models import Category, Publishable
 from ella_hub import conf
 
-from ella_hub.models import Role, Permission, ModelPermission, PrincipalRoleRelation
+from ella_hub.models import Role, Permission, ModelPermission
 from ella_hub.models import State, Transition, Workflow
 from ella_hub.models import (
+    ScheduledTransition,
+    StateCount,
     StateObjectRelation,
+    TransitionLog,
     WorkflowModelRelation,
     WorkflowPermissionRelation,
     StatePermissionRelation
 )
-from ella_hub.utils.perms import grant_permission
+from ella_hub.utils.cache import VersionedCache
+from ella_hub.utils.perms import PERMISSIONS_VERSION_KEY, get_permission_matrix, invalidate_after_bulk
+from ella_hub.utils.timezone import now
+
+
+logger = logging.getLogger(__name__)
 
+# version of workflows bumped when workflows, their states and transitions
+# or workflows of models change
+WORKFLOWS_VERSION_KEY = "HUB_workflows_version"
+
+# workflows of models by content type ID
+workflow_cache = VersionedCache(
+    "HUB_get_workflow",
+    WORKFLOWS_VERSION_KEY,
+    timeout=conf.STATES_CACHE_TIMEOUT,
+    local_timeout=conf.STATES_LOCAL_CACHE_TIMEOUT,
+    local_size=conf.STATES_LOCAL_CACHE_SIZE
+)
 
-def init_ella_workflow(resources):
+
+# Ella workflow specification, see ``load_workflow``
+ELLA_WORKFLOW = {
+    "title": "Ella workflow",
+    "description": "Workflow for Ella publishable-based models.",
+    "states": [
+        ("added", _("Added")),
+        ("ready", _("Ready")),
+        ("approved", _("Approved")),
+        ("published", _("Published")),
+        ("postponed", _("Postponed")),
+        ("deleted", _("Deleted")),
+    ],
+    "initial_state": "added",
+    # every state leads to every state
+    "transitions": "all",
+    "permissions": [
+        ("can_view", _("Can view"), False),
+        ("can_add", _("Can add"), False),
+        ("can_change", _("Can edit"), False),
+        ("can_delete", _("Can delete"), False),
+        ("readonly_content", "Readonly content", True),
+        ("disabled_authors", "Disabled authors", True),
+    ],
+    "roles": [
+        {
+            "title": _("Editor in chief"),
+            "models": {"*": ["can_view", "can_add", "can_change", "can_delete"]},
+            "states": {"*": ["can_view", "can_add", "can_change", "can_delete"]},
+        },
+        {
+            "title": _("Editor"),
+            "models": {
+                "*": ["can_view"],
+                "articles.article": ["readonly_content", "disabled_authors"],
+            },
+            "states": {
+                "added": ["can_view", "readonly_content", "disabled_authors"],
+                "ready": ["can_view", "readonly_content", "disabled_authors"],
+                "deleted": ["can_view", "readonly_content", "disabled_authors"],
+            },
+        },
+    ],
+}
+
+
+def init_ella_workflow(resources, spec=ELLA_WORKFLOW):
     """
-    Ella workflow specification here.
+    Sets Ella workflow to models of <resources>.
     """
-    workflow = Workflow.objects.get_or_create(
-        title="Ella workflow",
-        description="Workflow for Ella publishable-based models."
-    )[0]
+    models = [resource._meta.object_class for resource in resources]
+    workflow, changes = load_workflow(spec, models)
+    return workflow
 
-    editor_in_chief = Role.objects.get_or_create(title=unicode(_("Editor in chief")))[0]
 
-    STATES = (
-        (_("Added"), "added"),
-        (_("Ready"), "ready"),
-        (_("Approved"), "approved"),
-        (_("Published"), "published"),
-        (_("Postponed"), "postponed"),
-        (_("Deleted"), "deleted")
-    )
+def load_workflow(spec, models):
+    """
+    Makes workflow described by <spec> in database and sets it to <models>.
 
-    PERMISSIONS = (
-        (_("Can view"), "can_view"),
-        (_("Can add"), "can_add"),
-        (_("Can edit"), "can_change"),
-        (_("Can delete"), "can_delete"),
-    )
+    <spec> is a dict (see ``ELLA_WORKFLOW``) with workflow title, states
+    (codename, title), initial state, transitions ("all" or list of
+    (source, destination) codenames), permissions (codename, title, restriction)
+    and roles with permissions for models ("app_label.model" or "*" for all
+    <models>) and for states (codename or "*" for all states).
 
-    all_models = [resource._meta.object_class for resource in resources]
+    Database is compared with <spec> by a query per model and only missing
+    objects and relations are created by bulk inserts in one transaction.
+    Nothing is deleted. Returns tuple (workflow, {kind: number of created objects}).
+    """
+    changes = OrderedDict()
+    content_types = [ContentType.objects.get_for_model(model) for model in models]
+
+    with transaction.atomic():
+        workflow, created = Workflow.objects.get_or_create(title=spec["title"],
+            defaults={"description": spec.get("description", "")})
+        changes["workflows"] = int(created)
+
+        states = _create_missing(State.objects.filter(workflow=workflow), [
+            State(codename=codename, title=unicode(title), workflow=workflow)
+            for codename, title in spec["states"]
+        ], lambda state: state.codename, changes, "states")
+
+        initial_state = states[spec["initial_state"]]
+        changes["initial states"] = 0
+        if workflow.initial_state_id != initial_state.pk:
+            Workflow.objects.filter(pk=workflow.pk).update(initial_state=initial_state)
+            workflow.initial_state = initial_state
+            changes["initial states"] = 1
+
+        permissions = _create_missing(Permission.objects.filter(codename__in=[p[0] for p in spec["permissions"]]), [
+            Permission(codename=codename, title=unicode(title), restriction=restriction)
+            for codename, title, restriction in spec["permissions"]
+        ], lambda permission: permission.codename, changes, "permissions")
+
+        roles = _create_missing(Role.objects.filter(title__in=[unicode(r["title"]) for r in spec["roles"]]), [
+            Role(title=unicode(role["title"])) for role in spec["roles"]
+        ], lambda role: role.title, changes, "roles")
+
+        if spec["transitions"] == "all":
+            pairs = [(source, destination) for source in states for destination in states]
+        else:
+            pairs = [tuple(pair) for pair in spec["transitions"]]
+
+        transitions = _create_missing(Transition.objects.filter(workflow=workflow), [
+            Transition(title="to %s" % states[codename].title, workflow=workflow, destination=states[codename])
+            for codename in OrderedDict.fromkeys(destination for source, destination in pairs)
+        ], lambda transition: transition.destination_id, changes, "transitions")
+
+        through = State.transitions.through
+        _create_missing_relations(through.objects.filter(state__in=states.values()), [
+            through(state_id=states[source].pk, transition_id=transitions[states[destination].pk].pk)
+            for source, destination in pairs
+        ], ('state_id', 'transition_id'), changes, "state transitions")
+
+        _create_missing_relations(WorkflowPermissionRelation.objects.filter(workflow=workflow), [
+            WorkflowPermissionRelation(workflow=workflow, permission=permission)
+            for permission in permissions.values()
+        ], ('workflow_id', 'permission_id'), changes, "workflow permissions")
+
+        model_permissions, state_permissions = [], []
+        for role_spec in spec["roles"]:
+            role = roles[unicode(role_spec["title"])]
+            for model_key, codenames in role_spec.get("models", {}).items():
+                if model_key == "*":
+                    role_content_types = content_types
+                else:
+                    role_content_types = [ContentType.objects.get_by_natural_key(*model_key.split("."))]
+                model_permissions.extend(
+                    ModelPermission(role=role, content_type=content_type, permission=permissions[codename])
+                    for content_type in role_content_types for codename in codenames
+                )
+
+            for state_key, codenames in role_spec.get("states", {}).items():
+                role_states = states.values() if state_key == "*" else [states[state_key]]
+                state_permissions.extend(
+                    StatePermissionRelation(role=role, state=state, permission=permissions[codename])
+                    for state in role_states for codename in codenames
+                )
+
+        _create_missing_relations(ModelPermission.objects.filter(role__in=roles.values()), model_permissions,
+            ('role_id', 'content_type_id', 'permission_id'), changes, "model permissions")
+        _create_missing_relations(StatePermissionRelation.objects.filter(state__in=states.values()),
+            state_permissions, ('role_id', 'state_id', 'permission_id'), changes, "state permissions")
+
+        # set workflow to models
+        relations = dict(WorkflowModelRelation.objects.filter(
+            content_type__in=content_types).values_list('content_type_id', 'workflow_id'))
+        changed_ids = [ct.pk for ct in content_types if ct.pk in relations and relations[ct.pk] != workflow.pk]
+        new_ids = [ct.pk for ct in content_types if ct.pk not in relations]
+        if changed_ids:
+            WorkflowModelRelation.objects.filter(content_type__in=changed_ids).update(workflow=workflow)
+        WorkflowModelRelation.objects.bulk_create([
+            WorkflowModelRelation(content_type_id=pk, workflow=workflow)
+            for pk in OrderedDict.fromkeys(new_ids)
+        ])
+        changes["workflow models"] = len(set(changed_ids + new_ids))
+
+    if any(changes.values()):
+        invalidate_after_bulk(PERMISSIONS_VERSION_KEY, WORKFLOWS_VERSION_KEY)
+
+    return workflow, changes
+
+
+def _create_missing(queryset, objects, key, changes, kind):
+    """
+    Creates <objects> which aren't in <queryset> (compared by <key>
+    function) by one bulk insert. Returns {key: object} of all objects.
+    """
+    existing = dict((key(obj), obj) for obj in queryset)
+    missing = OrderedDict()
+    for obj in objects:
+        if key(obj) not in existing:
+            missing.setdefault(key(obj), obj)
 
-    perm_obj_list = []
+    changes[kind] = len(missing)
+    if missing:
+        queryset.model.objects.bulk_create(missing.values())
+        # bulk_create doesn't set primary keys
+        existing = dict((key(obj), obj) for obj in queryset.all())
+    return existing
 
-    state_obj_list = _create_states(STATES, workflow)
-    workflow.initial_state = state_obj_list[0]
-    workflow.save()
 
-    _make_all_possible_transitions(state_obj_list, workflow)
+def _create_missing_relations(queryset, relations, fields, changes, kind):
+    """
+    Creates <relations> which aren't in <queryset> (compared by values
+    of <fields>) by one bulk insert.
+    """
+    existing = set(queryset.values_list(*fields))
+    missing = OrderedDict()
+    for relation in relations:
+        values = tuple(getattr(relation, field) for field in fields)
+        if values not in existing:
+            missing.setdefault(values, relation)
 
-    # set workflow to all models
-    for model in all_models:
-        workflow.set_to_model(model)
+    changes[kind] = len(missing)
+    queryset.model.objects.bulk_create(missing.values())
 
-    # create basic permissions
-    for (perm_name, perm_codename) in PERMISSIONS:
-        p = Permission.objects.get_or_create(title=unicode(perm_name), codename=perm_codename)[0]
-        perm_obj_list.append(p)
 
-    # map permissions to models for roles (only for editor in chief)
-    for model in all_models:
-        content_type = ContentType.objects.get_for_model(model)
-        for perm_obj in perm_obj_list:
-            ModelPermission.objects.get_or_create(
-                role=editor_in_chief,
-                permission=perm_obj,
-                content_type=content_type
-            )
+def get_workflow(model):
+    """
+    Returns workflow set to <model>.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    return workflow_cache.get_or_set(content_type.pk, lambda: _load_workflow(content_type))
 
-    for perm_obj in perm_obj_list:
-        WorkflowPermissionRelation.objects.get_or_create(
-            workflow=workflow,
-            permission=perm_obj
-        )
 
-        for state_obj in state_obj_list:
-            StatePermissionRelation.objects.get_or_create(
-                state=state_obj,
-                permission=perm_obj,
-                role=editor_in_chief
-            )
+def _load_workflow(content_type):
+    try:
+        relation = WorkflowModelRelation.objects.select_related('workflow').get(content_type=content_type)
+    except WorkflowModelRelation.DoesNotExist:
+        return False
+    return relation.workflow
 
-    # Editor
-    editor = Role.objects.get_or_create(title=unicode(_("Editor")))[0]
 
-    STATES = (
-        (_("Added"), "added"),
-        (_("Ready"), "ready"),
-        (_("Deleted"), "deleted")
-    )
+def update_permissions(model, state=None):
+    """
+    Makes permissions of workflow for <model> (from ModelPermission relation)
+    the same as permissions of its current state (or <state>). Only
+    the difference is written - by one DELETE and one bulk INSERT.
+    """
+    workflow = get_workflow(model)
+    if state is None:
+        state = get_state(model)
 
-    # create states
+    content_type = ContentType.objects.get_for_model(model)
+    workflow_perm_ids = set(WorkflowPermissionRelation.objects.filter(
+        workflow=workflow).values_list('permission_id', flat=True))
+    state_perms = set(StatePermissionRelation.objects.filter(
+        state=state).values_list('role_id', 'permission_id'))
+
+    with transaction.atomic():
+        existing = {}
+        relations = ModelPermission.objects.filter(
+            content_type=content_type,
+            permission__in=workflow_perm_ids | set(p for _, p in state_perms)
+        ).values_list('pk', 'role_id', 'permission_id')
+        for pk, role_id, permission_id in relations:
+            existing[(role_id, permission_id)] = pk
+
+        revoked = [
+            pk for (role_id, permission_id), pk in existing.items()
+            if permission_id in workflow_perm_ids and (role_id, permission_id) not in state_perms
+        ]
+        granted = [
+            ModelPermission(role_id=role_id, content_type=content_type, permission_id=permission_id)
+            for (role_id, permission_id) in state_perms
+            if (role_id, permission_id) not in existing
+        ]
+
+        if revoked:
+            ModelPermission.objects.filter(pk__in=revoked).delete()
+        ModelPermission.objects.bulk_create(granted)
+
+    # revocations are invalidated here too, so the version
+    # doesn't depend on signals of deleted rows
+    if granted or revoked:
+        invalidate_after_bulk(PERMISSIONS_VERSION_KEY)
+
+
+def set_state(obj, state, user=None):
+    """
+    Sets <state> of <obj>. Change is logged in transition history
+    as made by <user>.
+    """
+    if not isinstance(state, State):
+        try:
+            state = get_cached_object(State, codename=state)
+        except State.DoesNotExist:
+            return False
 
-    all_models = [resource._meta.object_class for resource in resources]
+    content_type = ContentType.objects.get_for_model(obj)
+    category_id = _get_category_id(obj)
+    with transaction.atomic():
+        old_state_id = _upsert_state(content_type, obj.pk, state)
+        if old_state_id != state.pk:
+            deltas = {(state.pk, category_id): 1}
+            if old_state_id is not None:
+                deltas[(old_state_id, category_id)] = -1
+            update_state_counts(content_type, deltas)
+            TransitionLog.objects.create(content_type=content_type, content_id=obj.pk,
+                from_state_id=old_state_id, to_state=state, user=_get_user(user))
+        update_permissions(obj, state)
+
+    state_map.set(content_type, obj.pk, state)
+    return True
 
-    state_obj_list = _create_states(STATES, workflow)
 
-    # only view permissions
-    for model in all_models:
-        content_type = ContentType.objects.get_for_model(model)
-        for perm_obj in perm_obj_list[:1]:
-            ModelPermission.objects.get_or_create(
-                role=editor,
-                permission=perm_obj,
-                content_type=content_type
-            )
+def _get_user(user):
+    """Returns <user> if it's authenticated user (AnonymousUser can't be logged)."""
+    if user is not None and user.is_authenticated():
+        return user
+    return None
 
-    for perm_obj in perm_obj_list[:1]:
-        WorkflowPermissionRelation.objects.get_or_create(
-            workflow=workflow,
-            permission=perm_obj
-        )
 
-        for state_obj in state_obj_list:
-            StatePermissionRelation.objects.get_or_create(
-                state=state_obj,
-                permission=perm_obj,
-                role=editor
-            )
-
-    r = Permission.objects.get_or_create(
-        title="Readonly content",
-        restriction=True,
-        codename="readonly_content"
-    )[0]
-    d = Permission.objects.get_or_create(
-        title="Disabled authors",
-        restriction=True,
-        codename="disabled_authors"
-    )[0]
-
-    content_type = ContentType.objects.get_for_model(Article)
-
-    ModelPermission.objects.get_or_create(
-        role=editor,
-        permission=r,
-        content_type=content_type
-    )
-    ModelPermission.objects.get_or_create(
-        role=editor,
-        permission=d,
-        content_type=content_type
-    )
+def _upsert_state(content_type, content_id, state):
+    """
+    Sets <state> of object by one UPDATE or INSERT and returns ID
+    of its previous state. Row of the object stays locked until
+    the end of transaction, so concurrent upserts are serialized.
+    """
+    relations = StateObjectRelation.objects.select_for_update().filter(
+        content_type=content_type, content_id=content_id)
+    old_state_ids = list(relations.values_list('state_id', flat=True))
 
-    WorkflowPermissionRelation.objects.get_or_create(
-        workflow=workflow,
-        permission=r
-    )
-    WorkflowPermissionRelation.objects.get_or_create(
-        workflow=workflow,
-        permission=d
+    if not old_state_ids:
+        try:
+            with transaction.atomic():
+                StateObjectRelation.objects.create(content_type=content_type,
+                    content_id=content_id, state=state)
+            return None
+        except IntegrityError:
+            # inserted by concurrent request, lock its row and update it
+            old_state_ids = list(relations.values_list('state_id', flat=True))
+
+    if old_state_ids[0] != state.pk:
+        relations.update(state=state)
+    return old_state_ids[0]
+
+
+def set_states(model, ids, state, force=False, user=None, permission=None):
+    """
+    Sets <state> of <model> objects with <ids> if workflow transitions
+    allow it (or always if <force> is True). Objects without state can be
+    switched to initial state of the workflow and to states reachable from it.
+    If <permission> is given, roles of <user> need it in current state
+    of the object. State relations and transition history are written
+    in bulk and permissions are updated once. Returns dict {id: error or None}.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    category_field = get_category_field(model)
+    matrix = get_permission_matrix()
+    ids = list(OrderedDict.fromkeys(ids))
+    results = {}
+
+    if permission is not None:
+        permission_id = matrix.permissions.get(permission, (None, None))[0]
+        mask = matrix.get_user_mask(user)
+
+    with transaction.atomic():
+        objects = model._default_manager.filter(pk__in=ids)
+        if category_field:
+            categories = dict(objects.values_list('pk', category_field.attname))
+        else:
+            categories = dict.fromkeys(objects.values_list('pk', flat=True))
+        current_states = dict(StateObjectRelation.objects.select_for_update().filter(
+            content_type=content_type,
+            content_id__in=categories.keys()
+        ).values_list('content_id', 'state_id'))
+
+        changed_ids, new_ids = [], []
+        deltas = defaultdict(int)
+        for pk in ids:
+            current_state_id = current_states.get(pk)
+            if pk not in categories:
+                results[pk] = "Object does not exist."
+            elif permission is not None and not _has_state_permission(
+                    matrix, user, mask, content_type.pk, permission_id, current_state_id):
+                results[pk] = "Permission %s is required in current state." % permission
+            elif current_state_id == state.pk:
+                results[pk] = None
+            elif not force and state.codename not in matrix.get_allowed_states(content_type.pk, current_state_id):
+                results[pk] = "Transition to state %s is not allowed." % state.codename
+            elif current_state_id is None:
+                new_ids.append(pk)
+                deltas[(state.pk, categories[pk])] += 1
+                results[pk] = None
+            else:
+                changed_ids.append(pk)
+                deltas[(current_state_id, categories[pk])] -= 1
+                deltas[(state.pk, categories[pk])] += 1
+                results[pk] = None
+
+        if changed_ids:
+            StateObjectRelation.objects.filter(
+                content_type=content_type,
+                content_id__in=changed_ids
+            ).update(state=state)
+        StateObjectRelation.objects.bulk_create([
+            StateObjectRelation(content_type=content_type, content_id=pk, state=state)
+            for pk in new_ids
+        ])
+        update_state_counts(content_type, deltas)
+        TransitionLog.objects.bulk_create([
+            TransitionLog(content_type=content_type, content_id=pk, from_state_id=current_states.get(pk),
+                to_state=state, user=_get_user(user))
+            for pk in changed_ids + new_ids
+        ])
+
+        if changed_ids or new_ids:
+            update_permissions(model, state)
+
+    for pk in changed_ids + new_ids:
+        state_map.set(content_type, pk, state)
+    return results
+
+
+def schedule_state(obj, state, due):
+    """
+    Schedules switch of <obj> to <state> at <due> time.
+    """
+    return ScheduledTransition.objects.create(
+        content_type=ContentType.objects.get_for_model(obj),
+        content_id=obj.pk,
+        state=state,
+        due=due
     )
 
-    for state_obj in state_obj_list:
-        StatePermissionRelation.objects.get_or_create(
-            state=state_obj,
-            permission=r,
-            role=editor
-        )
-        StatePermissionRelation.objects.get_or_create(
-            state=state_obj,
-            permission=d,
-            role=editor
-        )
 
-    return workflow
+def process_scheduled_transitions(batch_size=None, until=None):
+    """
+    Applies transitions scheduled before <until> (now by default). Due
+    transitions are claimed in batches of <batch_size> rows locked until
+    the batch is applied, objects of every batch are switched by one
+    ``set_states`` call per model and state. Transitions of one object
+    are applied in order of their due time. Applied transitions are deleted,
+    failed ones are kept with their error and skipped by later runs.
+    Returns tuple (applied, failed).
+    """
+    batch_size = batch_size or conf.SCHEDULED_TRANSITIONS_BATCH_SIZE
+    until = until or now()
+    applied = failed = 0
+
+    while True:
+        with transaction.atomic():
+            batch = list(ScheduledTransition.objects.select_for_update().filter(
+                due__lte=until, error=""
+            ).order_by('due', 'pk').values_list('pk', 'content_type', 'content_id', 'state')[:batch_size])
+            if not batch:
+                break
+
+            # n-th transition of every object goes to n-th round,
+            # so the object is switched at most once per round
+            rounds = defaultdict(int)
+            groups = OrderedDict()
+            for pk, content_type_id, content_id, state_id in batch:
+                step = rounds[(content_type_id, content_id)]
+                rounds[(content_type_id, content_id)] += 1
+                groups.setdefault((step, content_type_id, state_id), {})[content_id] = pk
+
+            done = []
+            errors = defaultdict(list)
+            for (step, content_type_id, state_id), rows in sorted(groups.items(), key=lambda item: item[0][0]):
+                model = ContentType.objects.get_for_id(content_type_id).model_class()
+                if model is None:
+                    errors["Model does not exist."].extend(rows.values())
+                    continue
+
+                state = get_cached_object(State, pk=state_id)
+                for content_id, error in set_states(model, list(rows), state).items():
+                    if error is None:
+                        done.append(rows[content_id])
+                    else:
+                        errors[error].append(rows[content_id])
+                        logger.warning("Scheduled transition of %s #%s failed: %s", model.__name__, content_id, error)
+
+            ScheduledTransition.objects.filter(pk__in=done).delete()
+            # one UPDATE per distinct error
+            for error, pks in errors.items():
+                ScheduledTransition.objects.filter(pk__in=pks).update(error=error[:255])
+
+            applied += len(done)
+            failed += sum(len(pks) for pks in errors.values())
+
+    return applied, failed
+
+
+def remove_state(obj):
+    """
+    Removes state of <obj>, f.e. when the object is deleted.
+    """
+    content_type = ContentType.objects.get_for_model(obj)
+    with transaction.atomic():
+        relations = StateObjectRelation.objects.select_for_update().filter(
+            content_type=content_type, content_id=obj.pk)
+        state_ids = list(relations.values_list('state_id', flat=True))
+        if state_ids:
+            relations.delete()
+            update_state_counts(content_type, {(state_ids[0], _get_category_id(obj)): -1})
 
+    state_map.set(content_type, obj.pk, None)
 
-def _create_states(states, workflow):
-    state_obj_list = []
-    for state_name, state_codename in states:
-        s = State.objects.get_or_create(
-            title=unicode(state_name),
-            codename=state_codename,
-            workflow=workflow
-        )[0]
-        state_obj_list.append(s)
-    return state_obj_list
 
+def update_state_category(obj):
+    """
+    Moves <obj> between state counters of categories when its category
+    is changed. It has to be called before <obj> is saved.
+    """
+    category_field = get_category_field(obj.__class__)
+    if category_field is None or obj.pk is None:
+        return
+
+    try:
+        old_category_id = obj.__class__._default_manager.filter(
+            pk=obj.pk).values_list(category_field.attname, flat=True)[0]
+    except IndexError:
+        return
 
-def _make_all_possible_transitions(state_obj_list, workflow):
-    for state_obj_dest in state_obj_list:
-        t = Transition.objects.get_or_create(
-            title="to %s" % state_obj_dest.title,
-            workflow=workflow,
-            destination=state_obj_dest
-        )[0]
+    category_id = getattr(obj, category_field.attname)
+    if old_category_id == category_id:
+        return
 
-        for state_obj_src in state_obj_list:
-            state_obj_src.transitions.add(t)
-            state_obj_src.save()
+    content_type = ContentType.objects.get_for_model(obj)
+    for state_id in StateObjectRelation.objects.filter(content_type=content_type,
+            content_id=obj.pk).values_list('state_id', flat=True):
+        update_state_counts(content_type, {
+            (state_id, old_category_id): -1,
+            (state_id, category_id): 1,
+        })
 
 
-def get_workflow(model):
+def get_category_field(model):
     """
-    Returns workflow set to <model>.
+    Returns category field of <model> or None if objects of <model>
+    have no category.
     """
-    content_type = ContentType.objects.get_for_model(model)
-    cache_key = WorkflowModelRelation.cache_key(content_type.pk)
-    workflow = cache.get(cache_key)
-    if workflow is None:
-        try:
-            relation = WorkflowModelRelation.objects.get(content_type=content_type)
-        except WorkflowModelRelation.DoesNotExist:
-            workflow = False
-        else:
-            workflow = relation.workflow
-        cache.set(cache_key, workflow, timeout=conf.STATES_CACHE_TIMEOUT)
+    try:
+        field = model._meta.get_field('category')
+    except FieldDoesNotExist:
+        return None
+
+    if getattr(field, 'rel', None) and issubclass(field.rel.to, Category):
+        return field
+    return None
+
+
+def _get_category_id(obj):
+    category_field = get_category_field(obj.__class__)
+    if category_field is None:
+        return None
+    return getattr(obj, category_field.attname)
 
-    return workflow
 
+def _get_category_key(category_id):
+    if category_id is None:
+        return StateCount.NO_CATEGORY
+    return category_id
 
-def update_permissions(model):
+
+def update_state_counts(content_type, deltas):
     """
-    1. Remove all permissions for the workflow (from ModelPermission relation)
-    2. Grant permission for the current state (to ModelPermission relation)
+    Adds <deltas> ({(state_id, category_id): delta}) to state counters
+    of <content_type>. Counters are changed atomically in the database.
     """
-    workflow = get_workflow(model)
-    state = get_state(model)
+    for (state_id, category_id), delta in deltas.items():
+        if not delta:
+            continue
+
+        category_key = _get_category_key(category_id)
+        counters = StateCount.objects.filter(content_type=content_type,
+            state=state_id, category_key=category_key)
+        if counters.update(count=F('count') + delta):
+            continue
+
+        try:
+            with transaction.atomic():
+                StateCount.objects.create(content_type=content_type,
+                    state_id=state_id, category_key=category_key, count=delta)
+        except IntegrityError:
+            # created by concurrent request in the meantime
+            counters.update(count=F('count') + delta)
 
+
+def get_state_counts(model, category=None):
+    """
+    Returns {state codename: number of objects} of <model> (in <category>)
+    for all states of its workflow.
+    """
     content_type = ContentType.objects.get_for_model(model)
-    perms = [
-        wpr.permission
-        for wpr in WorkflowPermissionRelation.objects.filter(workflow=workflow).select_related('permission')
-    ]
+    matrix = get_permission_matrix()
+    workflow_id = matrix.workflows.get(content_type.pk)
+
+    counts = OrderedDict(
+        (state.codename, 0) for state in sorted(matrix.states.values(), key=lambda s: s.pk)
+        if state.workflow_id == workflow_id
+    )
 
-    ModelPermission.objects.filter(
-        content_type=content_type,
-        permission__in=perms
-    ).delete()
+    counters = StateCount.objects.filter(content_type=content_type)
+    if category is not None:
+        counters = counters.filter(category_key=getattr(category, 'pk', category))
+    for state_id, count in counters.values_list('state').annotate(Sum('count')).order_by():
+        state = matrix.states.get(state_id)
+        if state is not None:
+            counts[state.codename] = counts.get(state.codename, 0) + count
 
-    for relation in StatePermissionRelation.objects.filter(state=state):
-        grant_permission(model, relation.role, relation.permission)
+    return counts
 
 
-def set_state(obj, state):
+def rebuild_state_counts():
     """
-    Sets <state> of <obj>.
+    Recomputes all state counters from state relations - by one GROUP BY
+    query and one more for every model with categories. Returns number
+    of created counters.
     """
-    if not isinstance(state, State):
-        try:
-            state = get_cached_object(State, codename=state)
-        except State.DoesNotExist:
-            return False
+    counters = []
+    totals = StateObjectRelation.objects.exclude(content_type=None).values_list(
+        'content_type', 'state').annotate(Count('id')).order_by()
+
+    by_category = {}
+    for content_type_id, state_id, count in totals:
+        content_type = ContentType.objects.get_for_id(content_type_id)
+        model = content_type.model_class()
+        category_field = get_category_field(model) if model else None
+        if category_field is None:
+            counters.append(StateCount(content_type=content_type, state_id=state_id, count=count))
+        else:
+            by_category[content_type] = category_field
+
+    for content_type, category_field in by_category.items():
+        for state_id, category_id, count in _count_states_by_category(content_type, category_field):
+            counters.append(StateCount(content_type=content_type, state_id=state_id,
+                category_key=_get_category_key(category_id), count=count))
+
+    with transaction.atomic():
+        StateCount.objects.all().delete()
+        StateCount.objects.bulk_create(counters)
+
+    return len(counters)
+
+
+def _count_states_by_category(content_type, category_field):
+    qn = connection.ops.quote_name
+    opts = category_field.model._meta
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT sor.state_id, obj.%(category)s, COUNT(*) "
+        "FROM %(sor)s sor INNER JOIN %(table)s obj ON obj.%(pk)s = sor.content_id "
+        "WHERE sor.content_type_id = %%s "
+        "GROUP BY sor.state_id, obj.%(category)s" % {
+            "category": qn(category_field.column),
+            "sor": qn(StateObjectRelation._meta.db_table),
+            "table": qn(opts.db_table),
+            "pk": qn(opts.pk.column),
+        }, [content_type.pk])
+    return cursor.fetchall()
+
+
+def reconcile_published_states():
+    """
+    Sets state "published" to published publishables in other state
+    (published outside of workflow, f.e. by ella admin). Mismatched objects
+    are found by one query and fixed in bulk per model. Returns number
+    of fixed objects.
+    """
+    qn = connection.ops.quote_name
+    publishables = Publishable.objects.filter(published=True).extra(where=[
+        "NOT EXISTS (SELECT 1 FROM %(sor)s INNER JOIN %(state)s ON %(state)s.id = %(sor)s.state_id "
+        "WHERE %(sor)s.content_type_id = %(publishable)s.content_type_id "
+        "AND %(sor)s.content_id = %(publishable)s.id AND %(state)s.codename = %%s)" % {
+            "sor": qn(StateObjectRelation._meta.db_table),
+            "state": qn(State._meta.db_table),
+            "publishable": qn(Publishable._meta.db_table),
+        }
+    ], params=["published"])
+
+    ids_by_content_type = defaultdict(list)
+    for content_type_id, pk in publishables.values_list('content_type', 'id'):
+        ids_by_content_type[content_type_id].append(pk)
+
+    matrix = get_permission_matrix()
+    fixed = 0
+    for content_type_id, ids in ids_by_content_type.items():
+        # models without workflow or without "published" state in it are skipped
+        state = _get_published_state(matrix, matrix.workflows.get(content_type_id))
+        if state is None:
+            continue
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is None:
+            continue
+
+        results = set_states(model, ids, state, force=True)
+        fixed += len([error for error in results.values() if error is None])
+
+    return fixed
+
+
+def _get_published_state(matrix, workflow_id):
+    if workflow_id is None:
+        return None
+    for state in matrix.states.values():
+        if state.workflow_id == workflow_id and state.codename == "published":
+            return state
+    return None
 
-    content_type = ContentType.objects.get_for_model(obj)
-    try:
-        relation = StateObjectRelation.objects.get(
-            content_type=content_type,
-            content_id=obj.id
-        )
-    except StateObjectRelation.DoesNotExist:
-        StateObjectRelation.objects.create(content_object=obj, state=state)
-    else:
-        relation.state = state
-        relation.save()
-    update_permissions(obj)
-    return True
+
+class StateIdentityMap(threading.local):
+    """
+    States of objects read or set during current request, so repeated
+    reads of the same object (nested resources, state fields) don't query
+    database. The map is active only between ``request_started`` and
+    ``request_finished`` signals, outside of requests it's empty.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.states = {}
+
+    def start(self):
+        self.active = True
+        self.states = {}
+
+    def finish(self):
+        self.active = False
+        self.states = {}
+
+    def get(self, content_type, content_id):
+        """Returns (found, state) of object."""
+        key = (content_type.pk, content_id)
+        return key in self.states, self.states.get(key)
+
+    def set(self, content_type, content_id, state):
+        if self.active:
+            self.states[(content_type.pk, content_id)] = state
+
+
+state_map = StateIdentityMap()
 
 
 def get_state(obj):
     """
-    Returns state of <obj>.
+    Returns state of <obj> (there's at most one state relation per object).
     """
     content_type = ContentType.objects.get_for_model(obj)
+    found, state = state_map.get(content_type, obj.pk)
+    if found:
+        return state
+
     try:
         relation = StateObjectRelation.objects.select_related('state').get(
             content_id=obj.pk,
             content_type=content_type
         )
     except StateObjectRelation.DoesNotExist:
-        return None
+        state = None
     else:
-        return relation.state
+        state = relation.state
+
+    state_map.set(content_type, obj.pk, state)
+    return state
+
+
+def get_states(model, ids):
+    """
+    Returns {id: state} of <model> objects with <ids>. States which
+    aren't in the request's identity map are loaded by one query.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    states, missing_ids = {}, []
+    for pk in ids:
+        found, state = state_map.get(content_type, pk)
+        if found:
+            states[pk] = state
+        else:
+            missing_ids.append(pk)
+
+    if missing_ids:
+        loaded = StateObjectRelation.objects.get_for_ids_as_dict(missing_ids, content_type)
+        for pk in missing_ids:
+            states[pk] = loaded.get(pk)
+            state_map.set(content_type, pk, states[pk])
+
+    return states
+
+
+def get_allowed_states(model, state):
+    """
+    Returns {codename: title} of states object of <model> in <state>
+    can be switched to by transitions of its workflow.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    state_id = state.pk if state else None
+    return get_permission_matrix().get_allowed_states(content_type.pk, state_id)
+
+
+def check_transitions(model, ids, codenames, user, permission="can_change"):
+    """
+    Returns {id: {codename: bool}} telling whether <user> can switch <model>
+    objects with <ids> to states with <codenames> (None for objects which
+    don't exist). Transition has to be allowed by workflow and roles of <user>
+    need <permission> in current state of the object. Objects with their current
+    states are loaded by one query, the rest is read from permission matrix.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    matrix = get_permission_matrix()
+    qn = connection.ops.quote_name
+    current_states = dict(model._default_manager.filter(pk__in=ids).extra(select={
+        "state_id": "SELECT %(sor)s.state_id FROM %(sor)s WHERE %(sor)s.content_type_id = %%s "
+            "AND %(sor)s.content_id = %(table)s.%(pk)s" % {
+                "sor": qn(StateObjectRelation._meta.db_table),
+                "table": qn(model._meta.db_table),
+                "pk": qn(model._meta.pk.column),
+            },
+    }, select_params=(content_type.pk,)).values_list('pk', 'state_id'))
+
+    permission_id = matrix.permissions.get(permission, (None, None))[0]
+    mask = matrix.get_user_mask(user)
+
+    # objects in the same state share the answer
+    allowed_by_state = {}
+    results = {}
+    for pk in ids:
+        if pk not in current_states:
+            results[pk] = None
+            continue
+
+        state_id = current_states[pk]
+        if state_id not in allowed_by_state:
+            allowed = set(matrix.get_allowed_states(content_type.pk, state_id))
+            if state_id in matrix.states:
+                allowed.add(matrix.states[state_id].codename)
+
+            permitted = _has_state_permission(matrix, user, mask, content_type.pk, permission_id, state_id)
+            allowed_by_state[state_id] = allowed if permitted else set()
+
+        results[pk] = dict((codename, codename in allowed_by_state[state_id]) for codename in codenames)
+    return results
+
+
+def _has_state_permission(matrix, user, mask, content_type_id, permission_id, state_id):
+    return user.is_active and (user.is_superuser or
+        matrix.has_permission(mask, content_type_id, permission_id, state_id))
 
 
 def get_init_states(model, user, workflow=None):
     """
-    Returns initial state of <workflow> set to <model>
-    - vsetky stavy, do ktorych sa je mozne z init stavu dostat
+    Returns states <user> has permissions for in <model>. If <workflow>
+    is specified, only states reachable from its initial state are returned.
     """
     content_type = ContentType.objects.get_for_model(model)
-    init_state = []
+    matrix = get_permission_matrix()
 
     if workflow:
-        init_state = workflow.initial_state
+        workflow_id = workflow.pk
+    elif content_type.pk in matrix.workflows:
+        workflow_id = None
     else:
-        try:
-            WorkflowModelRelation.objects.get(content_type=content_type)
-        except WorkflowModelRelation.DoesNotExist:
-            return []
-
-    if user.is_superuser:
-        cache_key = 'init_states_SU'
-        cached_roles = cache.get(cache_key)
-        if cached_roles is None:
-            cached_roles = [
-                relation.role
-                for relation in PrincipalRoleRelation.objects.all().select_related('role')
-            ]
-            cache.set(cache_key, cached_roles, timeout=conf.STATES_CACHE_TIMEOUT)
-
-    else:
-        cache_key = 'init_states_user_%s_%s' % (user.pk, content_type.pk)
-        cached_roles = cache.get(cache_key)
-        if cached_roles is None:
-            relations = PrincipalRoleRelation.objects.filter(user=user).select_related('role')
-            cached_roles = [relation.role for relation in relations]
-            cache.set(cache_key, cached_roles, timeout=conf.STATES_CACHE_TIMEOUT)
-
-    relations = ModelPermission.objects.filter(
-        content_type=content_type,
-        role__in=cached_roles
-    ).select_related('permission')
-
-    perms = [relation.permission for relation in relations]
-
-    relations = StatePermissionRelation.objects.filter(
-        role__in=cached_roles,
-        permission__in=perms
-    ).select_related('state')
-    states = set([relation.state for relation in relations])
-    if init_state:
-        states = filter(lambda state: state in init_state.transitions, states)
+        return []
 
-    return states
+    return matrix.get_init_states(content_type.pk, matrix.get_user_mask(user), workflow_id)
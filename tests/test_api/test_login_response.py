@@ -1,10 +1,13 @@
 from nose import tools
 
 from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
 from django.utils import simplejson as json
 
+from ella_hub.models import StatePermissionRelation
 from ella_hub.utils import get_all_resource_classes
 from ella_hub.utils.perms import add_role
 from ella_hub.utils.test_helpers import create_advanced_workflow, delete_test_workflow
@@ -70,6 +73,27 @@ class TestLoginResponse(TestCase):
         self.__logout(headers)
 
 
+    def test_login_payload_cached(self):
+        add_role(self.user, self.base_role)
+        self.user.is_superuser = False
+        self.user.save()
+
+        with CaptureQueriesContext(connection) as first_login:
+            api_key, auth_tree, system = self.__login("user", "pass")
+        with CaptureQueriesContext(connection) as second_login:
+            api_key, cached_auth_tree, cached_system = self.__login("user", "pass")
+
+        tools.assert_true(len(second_login) < len(first_login))
+        tools.assert_equals(cached_auth_tree, auth_tree)
+        tools.assert_equals(cached_system, system)
+        tools.assert_true("states" in auth_tree["articles"]["article"])
+
+        # cache is invalidated when permissions change
+        StatePermissionRelation.objects.filter(role=self.base_role).delete()
+        api_key, auth_tree, system = self.__login("user", "pass")
+        for resource in auth_tree["articles"].values():
+            tools.assert_false("states" in resource)
+
     def __create_test_user(self, username, password, is_admin=False):
         user = User.objects.create_user(username=username, password=password)
         user.is_staff = True
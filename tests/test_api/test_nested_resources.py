@@ -0,0 +1,118 @@
+import os
+import django.utils.simplejson as json
+
+from PIL import Image
+from nose import tools
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+
+from ella.articles.models import Article
+from ella.core.models import Author, Source
+from ella.photos.models import Photo
+from ella.utils.test_helpers import create_basic_categories
+from ella.utils import timezone
+
+from ella_hub.utils import get_all_resource_classes
+from ella_hub.utils.workflow import init_ella_workflow
+
+
+class TestNestedResources(TestCase):
+    def setUp(self):
+        self.user = self.__create_test_user("user", "pass", True)
+        self.client = Client()
+
+        init_ella_workflow(get_all_resource_classes())
+        create_basic_categories(self)
+
+        if not os.path.exists(settings.MEDIA_ROOT):
+            os.makedirs(settings.MEDIA_ROOT)
+        self.image_path = os.path.join(settings.MEDIA_ROOT, ".nested_resources.jpg")
+        Image.new("RGB", (20, 10), "yellow").save(self.image_path, format="jpeg")
+
+        self.source = Source.objects.create(name="Source")
+        self.authors = [Author.objects.create(name="Author %d" % i, slug="author-%d" % i)
+            for i in range(6)]
+
+    def tearDown(self):
+        self.user.delete()
+        Article.objects.all().delete()
+        Photo.objects.all().delete()
+        Author.objects.all().delete()
+        os.remove(self.image_path)
+
+    def test_query_count_independent_of_page_size(self):
+        """
+        Relations dehydrated with full=True are joined or prefetched,
+        so number of queries doesn't depend on number of objects.
+        """
+        api_key = self.__login("user", "pass")
+        headers = self.__build_headers("user", api_key)
+
+        query_counts = []
+        for i in range(2):
+            for j in range(3):
+                self.__create_article(i * 3 + j, self.authors[j:], self.authors[i * 3:i * 3 + j + 1])
+
+            # warms up caches of categories, permissions, ...
+            self.client.get("/admin-api/article/", **headers)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/admin-api/article/", **headers)
+            tools.assert_equals(response.status_code, 200)
+            resources = self.__get_response_json(response)["data"]
+            tools.assert_equals(len(resources), 3 + i * 3)
+            query_counts.append(len(queries))
+
+        tools.assert_equals(query_counts[0], query_counts[1])
+
+        article = [r for r in resources if r["slug"] == "article-5"][0]
+        tools.assert_equals(len(article["authors"]), 4)
+        tools.assert_equals(len(article["photo"]["authors"]), 3)
+        tools.assert_equals(article["photo"]["source"]["name"], "Source")
+
+    def test_detail(self):
+        api_key = self.__login("user", "pass")
+        headers = self.__build_headers("user", api_key)
+        article = self.__create_article(0, self.authors, self.authors[:2])
+
+        response = self.client.get("/admin-api/article/%d/" % article.pk, **headers)
+        tools.assert_equals(response.status_code, 200)
+        resource = self.__get_response_json(response)
+        tools.assert_equals(resource["category"]["site"]["id"], self.category.site_id)
+        tools.assert_equals(len(resource["photo"]["authors"]), 2)
+
+    def __create_article(self, number, authors, photo_authors):
+        photo = Photo.objects.create(title="Photo %d" % number, image=self.image_path, source=self.source)
+        photo.authors.add(*photo_authors)
+        article = Article.objects.create(title="Article %d" % number, slug="article-%d" % number,
+            category=self.category, publish_from=timezone.now(), published=False,
+            photo=photo, source=self.source)
+        article.authors.add(*authors)
+        return article
+
+    def __create_test_user(self, username, password, is_admin=False):
+        user = User.objects.create_user(username=username, password=password)
+        user.is_staff = True
+        user.is_superuser = is_admin
+        user.save()
+        return user
+
+    def __login(self, username, password):
+        response = self.client.post('/admin-api/login/', data={"username": username, "password": password})
+        tools.assert_equals(response.status_code, 200)
+
+        resources = self.__get_response_json(response)
+        tools.assert_true("api_key" in resources)
+
+        return resources["api_key"]
+
+    def __build_headers(self, username, api_key):
+        return {
+            "HTTP_AUTHORIZATION": "ApiKey %s:%s" % (username, api_key),
+        }
+
+    def __get_response_json(self, response):
+        return json.loads(response.content)
@@ -2,14 +2,15 @@ from urlparse import urlparse, urlsplit
 
 from nose import tools
 from django.test.client import Client, FakePayload, MULTIPART_CONTENT
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Permission as AuthPermission
 from django.test import TestCase
 import django.utils.simplejson as json
 
 from ella.core.models import Author
 
 from ella_hub.utils.test_helpers import create_basic_workflow, delete_test_workflow
-from ella_hub.utils.workflow import set_state, get_state
+from ella_hub.models import PrincipalRoleRelation, StatePermissionRelation
+from ella_hub.utils.workflow import set_state, get_state, check_transitions
 
 
 class PatchClient(Client):
@@ -103,6 +104,36 @@ class TestLoginResponse(TestCase):
 
         self.__logout(headers)
 
+    def test_filter_by_states_paginated(self):
+        author_three = Author.objects.create(id=102, name="3rd author", slug="3rd")
+
+        api_key = self.__login("user", "pass")
+        headers = self.__build_headers("user", api_key)
+
+        self.workflow.set_to_model(Author)
+        set_state(self.author, self.state1)
+        set_state(self.author_two, self.state2)
+        set_state(author_three, self.state3)
+
+        url = "/admin-api/author/?state__in=%s,%s&order_by=-state&limit=1" % (
+            self.state1.codename, self.state3.codename)
+
+        response = self.client.get(url, **headers)
+        tools.assert_equals(response.status_code, 200, response.content)
+        resources = self.__get_response_json(response)
+        tools.assert_equals(resources["meta"]["total_count"], 2)
+        tools.assert_equals([r["id"] for r in resources["data"]], [author_three.id])
+
+        response = self.client.get(url + "&offset=1", **headers)
+        resources = self.__get_response_json(response)
+        tools.assert_equals([r["id"] for r in resources["data"]], [self.author.id])
+        tools.assert_equals(resources["data"][0]["state"], self.state1.codename)
+
+        response = self.client.get("/admin-api/author/?order_by=state", **headers)
+        resources = self.__get_response_json(response)
+        tools.assert_equals([r["id"] for r in resources["data"]],
+            [self.author.id, self.author_two.id, author_three.id])
+
     def test_state_included(self):
         api_key = self.__login("user", "pass")
         headers = self.__build_headers("user", api_key)
@@ -144,6 +175,139 @@ class TestLoginResponse(TestCase):
 
         self.__logout(headers)
 
+    def test_set_states_in_bulk(self):
+        api_key = self.__login("user", "pass")
+        headers = self.__build_headers("user", api_key)
+
+        # objects without state go through initial state
+        self.workflow.save()
+        self.workflow.set_to_model(Author)
+        set_state(self.author, self.state1)
+
+        payload = json.dumps({
+            "resource": "author",
+            "ids": [self.author.id, self.author_two.id, 999],
+            "state": self.state2.codename,
+        })
+        response = self.client.post("/admin-api/set-state/", data=payload,
+            content_type="application/json", **headers)
+        tools.assert_equals(response.status_code, 202)
+        results = self.__get_response_json(response)["objects"]
+        tools.assert_equals([(r["id"], r["success"]) for r in results],
+            [(self.author.id, True), (self.author_two.id, True), (999, False)])
+        tools.assert_equals(get_state(self.author), self.state2)
+        tools.assert_equals(get_state(self.author_two), self.state2)
+
+        # state 2 leads only to state 3
+        payload = json.dumps({
+            "resource": "author",
+            "ids": [self.author.id],
+            "state": self.state1.codename,
+        })
+        response = self.client.post("/admin-api/set-state/", data=payload,
+            content_type="application/json", **headers)
+        results = self.__get_response_json(response)["objects"]
+        tools.assert_false(results[0]["success"])
+        tools.assert_in("error", results[0])
+        tools.assert_equals(get_state(self.author), self.state2)
+
+        response = self.client.post("/admin-api/set-state/", data="{}",
+            content_type="application/json", **headers)
+        tools.assert_equals(response.status_code, 400)
+
+    def test_set_states_needs_state_permission(self):
+        role_user = self.__create_test_user("role_user", "pass")
+        role_user.user_permissions.add(AuthPermission.objects.get(codename="change_author"))
+        PrincipalRoleRelation.objects.create(user=role_user, role=self.test_role)
+        set_state(self.author, self.state1)
+        set_state(self.author_two, self.state2)
+        StatePermissionRelation.objects.filter(state=self.state2, permission=self.can_change).delete()
+
+        api_key = self.__login("role_user", "pass")
+        headers = self.__build_headers("role_user", api_key)
+        payload = json.dumps({
+            "resource": "author",
+            "ids": [self.author.id, self.author_two.id],
+            "state": self.state3.codename,
+        })
+        response = self.client.post("/admin-api/set-state/", data=payload,
+            content_type="application/json", **headers)
+        tools.assert_equals(response.status_code, 202)
+        results = self.__get_response_json(response)["objects"]
+        tools.assert_equals([(r["id"], r["success"]) for r in results],
+            [(self.author.id, False), (self.author_two.id, False)])
+        # transition isn't allowed in state 1, permission is missing in state 2
+        tools.assert_in("not allowed", results[0]["error"])
+        tools.assert_in("can_change", results[1]["error"])
+        tools.assert_equals(get_state(self.author_two), self.state2)
+
+        role_user.delete()
+
+    def test_check_transitions(self):
+        api_key = self.__login("user", "pass")
+        headers = self.__build_headers("user", api_key)
+
+        author_three = Author.objects.create(id=102, name="3rd author", slug="3rd")
+        set_state(self.author, self.state1)
+        set_state(self.author_two, self.state2)
+
+        payload = json.dumps({
+            "resource": "author",
+            "ids": [self.author.id, self.author_two.id, author_three.id, 999],
+            "states": [self.state2.codename, self.state3.codename],
+        })
+        response = self.client.post("/admin-api/check-transitions/", data=payload,
+            content_type="application/json", **headers)
+        tools.assert_equals(response.status_code, 200)
+        tools.assert_equals(self.__get_response_json(response)["objects"], [
+            {"id": self.author.id, "states": {"state_2": True, "state_3": False}},
+            {"id": self.author_two.id, "states": {"state_2": True, "state_3": True}},
+            # workflow has no initial state
+            {"id": author_three.id, "states": {"state_2": False, "state_3": False}},
+            {"id": 999, "error": "Object does not exist."},
+        ])
+
+        # roles need permission to change object in its current state
+        role_user = self.__create_test_user("role_user", "pass")
+        PrincipalRoleRelation.objects.create(user=role_user, role=self.test_role)
+        StatePermissionRelation.objects.filter(state=self.state2, permission=self.can_change).delete()
+        ids = [self.author.id, self.author_two.id]
+        check_transitions(Author, ids, ["state_3"], role_user)
+        with self.assertNumQueries(1):
+            results = check_transitions(Author, ids, ["state_2", "state_3"], role_user)
+        tools.assert_equals(results, {
+            self.author.id: {"state_2": True, "state_3": False},
+            self.author_two.id: {"state_2": False, "state_3": False},
+        })
+
+        response = self.client.post("/admin-api/check-transitions/", data="{}",
+            content_type="application/json", **headers)
+        tools.assert_equals(response.status_code, 400)
+
+        role_user.delete()
+        author_three.delete()
+
+    def test_state_counts(self):
+        api_key = self.__login("user", "pass")
+        headers = self.__build_headers("user", api_key)
+
+        self.workflow.set_to_model(Author)
+        set_state(self.author, self.state1)
+        set_state(self.author_two, self.state1)
+        set_state(self.author_two, self.state2)
+
+        response = self.client.get("/admin-api/state-counts/author/", **headers)
+        tools.assert_equals(response.status_code, 200)
+        tools.assert_equals(self.__get_response_json(response),
+            {self.state1.codename: 1, self.state2.codename: 1, self.state3.codename: 0})
+
+        self.author_two.delete()
+        response = self.client.get("/admin-api/state-counts/author/", **headers)
+        tools.assert_equals(self.__get_response_json(response)[self.state2.codename], 0)
+
+        response = self.client.get("/admin-api/state-counts/unknown/", **headers)
+        tools.assert_equals(response.status_code, 400)
+
     def __create_test_user(self, username, password, is_admin=False):
         user = User.objects.create_user(username=username, password=password)
         user.is_staff = True
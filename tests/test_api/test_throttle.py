@@ -0,0 +1,142 @@
+import time
+
+from nose import tools
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import Client
+from django.utils import simplejson as json
+
+from ella_hub import conf, throttle as throttle_module
+from ella_hub.throttle import SlidingWindowThrottle
+from ella_hub.utils import get_resource_by_name
+
+
+class FrozenTime(object):
+    """Replaces time module in ella_hub.throttle."""
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+
+    def time(self):
+        return self.timestamp
+
+
+class TestThrottle(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="user", password="pass")
+        self.user.is_staff = True
+        self.user.is_superuser = True
+        self.user.save()
+        self.client = Client()
+        cache.clear()
+        # start of a window
+        self.time = FrozenTime(6000.0)
+        throttle_module.time = self.time
+
+    def tearDown(self):
+        throttle_module.time = time
+        self.user.delete()
+        cache.clear()
+
+    def test_window_slides(self):
+        throttle = SlidingWindowThrottle(2, 60, scope="test")
+
+        for i in range(2):
+            tools.assert_false(throttle.should_be_throttled("client"))
+            throttle.accessed("client")
+
+        tools.assert_true(throttle.should_be_throttled("client"))
+        tools.assert_true(throttle.should_be_throttled("client"))
+        tools.assert_false(throttle.should_be_throttled("other-client"))
+        tools.assert_equals(throttle.get_retry_after("client"), 90)
+
+        # throttled requests didn't use the budget
+        tools.assert_equals(cache.get(throttle.get_window_key("client", 100)), 2)
+
+        self.time.timestamp += 89
+        tools.assert_true(throttle.should_be_throttled("client"))
+        self.time.timestamp += 1
+        tools.assert_false(throttle.should_be_throttled("client"))
+        tools.assert_true(throttle.should_be_throttled("client"))
+
+    def test_login_throttled(self):
+        throttle_rates = conf.THROTTLE_RATES
+        conf.THROTTLE_RATES = {"login": (3, 60)}
+        try:
+            for i in range(3):
+                response = self.client.post("/admin-api/login/",
+                    data={"username": "user", "password": "wrong"})
+                tools.assert_equals(response.status_code, 401)
+
+            response = self.client.post("/admin-api/login/",
+                data={"username": "user", "password": "pass"})
+            tools.assert_equals(response.status_code, 429)
+            tools.assert_equals(response["Retry-After"], "80")
+        finally:
+            conf.THROTTLE_RATES = throttle_rates
+
+    def test_validate_api_key_has_own_budget(self):
+        throttle_rates = conf.THROTTLE_RATES
+        conf.THROTTLE_RATES = {"login": (1, 60), "validate_api_key": (2, 60)}
+        try:
+            response = self.client.post("/admin-api/login/",
+                data={"username": "user", "password": "pass"})
+            tools.assert_equals(response.status_code, 200)
+            headers = {
+                "HTTP_AUTHORIZATION": "ApiKey user:%s" % json.loads(response.content)["api_key"],
+            }
+
+            for i in range(2):
+                response = self.client.post("/admin-api/validate-api-key/", **headers)
+                tools.assert_equals(response.status_code, 200)
+
+            response = self.client.post("/admin-api/validate-api-key/", **headers)
+            tools.assert_equals(response.status_code, 429)
+            tools.assert_true(int(response["Retry-After"]) > 0)
+        finally:
+            conf.THROTTLE_RATES = throttle_rates
+
+    def test_client_identified_by_forwarded_header(self):
+        throttle_rates = conf.THROTTLE_RATES
+        client_identifier = conf.THROTTLE_CLIENT_IDENTIFIER
+        conf.THROTTLE_RATES = {"login": (1, 60)}
+        conf.THROTTLE_CLIENT_IDENTIFIER = "HTTP_X_FORWARDED_FOR"
+        try:
+            for address in ("10.0.0.1", "10.0.0.2"):
+                response = self.client.post("/admin-api/login/",
+                    data={"username": "user", "password": "wrong"},
+                    HTTP_X_FORWARDED_FOR="1.2.3.4, %s" % address)
+                tools.assert_equals(response.status_code, 401)
+
+            response = self.client.post("/admin-api/login/",
+                data={"username": "user", "password": "wrong"},
+                HTTP_X_FORWARDED_FOR="10.0.0.1")
+            tools.assert_equals(response.status_code, 429)
+        finally:
+            conf.THROTTLE_RATES = throttle_rates
+            conf.THROTTLE_CLIENT_IDENTIFIER = client_identifier
+
+    def test_list_endpoint_throttled(self):
+        response = self.client.post("/admin-api/login/",
+            data={"username": "user", "password": "pass"})
+        headers = {
+            "HTTP_AUTHORIZATION": "ApiKey user:%s" % json.loads(response.content)["api_key"],
+        }
+
+        resource = get_resource_by_name("author")
+        list_throttle = resource._meta.list_throttle
+        resource._meta.list_throttle = SlidingWindowThrottle(1, 60, scope="list")
+        try:
+            response = self.client.get("/admin-api/author/", **headers)
+            tools.assert_equals(response.status_code, 200)
+
+            response = self.client.get("/admin-api/author/", **headers)
+            tools.assert_equals(response.status_code, 429)
+            tools.assert_equals(response["Retry-After"], "120")
+
+            # detail requests are throttled by resource's default throttle
+            response = self.client.get("/admin-api/author/schema/", **headers)
+            tools.assert_equals(response.status_code, 200)
+        finally:
+            resource._meta.list_throttle = list_throttle
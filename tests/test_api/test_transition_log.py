@@ -0,0 +1,89 @@
+from nose import tools
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.client import Client
+import django.utils.simplejson as json
+
+from ella.core.models import Author
+
+from ella_hub.models import TransitionLog
+from ella_hub.utils.test_helpers import create_basic_workflow, delete_test_workflow
+from ella_hub.utils.workflow import set_state, set_states
+
+
+class TestTransitionLog(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="user", password="pass")
+        self.user.is_staff = True
+        self.user.is_superuser = True
+        self.user.save()
+        self.client = Client()
+        create_basic_workflow(self)
+        self.workflow.save()
+        self.workflow.set_to_model(Author)
+        self.author = Author.objects.create(name="Test author", slug="1st")
+        self.author_two = Author.objects.create(name="2nd author", slug="2nd")
+
+    def tearDown(self):
+        self.user.delete()
+        Author.objects.all().delete()
+        delete_test_workflow()
+
+    def test_transitions_logged(self):
+        set_state(self.author, self.state1, user=self.user)
+        set_state(self.author, self.state1)
+        set_states(Author, [self.author.pk, self.author_two.pk], self.state2)
+
+        logs = TransitionLog.objects.order_by('id')
+        tools.assert_equals(
+            [(l.content_id, l.from_state_id, l.to_state_id, l.user_id) for l in logs], [
+                (self.author.pk, None, self.state1.pk, self.user.pk),
+                (self.author.pk, self.state1.pk, self.state2.pk, None),
+                (self.author_two.pk, None, self.state2.pk, None),
+            ])
+
+    def test_keyset_pagination(self):
+        set_state(self.author_two, self.state1)
+        set_state(self.author, self.state1)
+        set_state(self.author, self.state2)
+        set_state(self.author, self.state3)
+
+        headers = self.__login("user", "pass")
+        url = "/admin-api/transitionlog/?content_type=author&content_id=%d&limit=2" % self.author.pk
+
+        response = self.client.get(url, **headers)
+        tools.assert_equals(response.status_code, 200, response.content)
+        resources = json.loads(response.content)
+        tools.assert_equals([(r["from_state"], r["to_state"]) for r in resources["data"]],
+            [(self.state2.codename, self.state3.codename), (self.state1.codename, self.state2.codename)])
+        tools.assert_true("total_count" not in resources["meta"])
+
+        response = self.client.get(resources["meta"]["next"], **headers)
+        resources = json.loads(response.content)
+        tools.assert_equals([(r["from_state"], r["to_state"]) for r in resources["data"]],
+            [(None, self.state1.codename)])
+        tools.assert_equals(resources["data"][0]["content_type"], "author")
+        tools.assert_equals(resources["meta"]["next"], None)
+
+    def test_content_type_round_trip(self):
+        set_state(self.author, self.state1)
+        set_state(self.author_two, self.state1)
+
+        headers = self.__login("user", "pass")
+        response = self.client.get("/admin-api/transitionlog/?content_id=%d" % self.author.pk, **headers)
+        resources = json.loads(response.content)
+        content_type = resources["data"][0]["content_type"]
+
+        url = "/admin-api/transitionlog/?content_type=%s&content_id=%d" % (content_type, self.author.pk)
+        response = self.client.get(url, **headers)
+        tools.assert_equals(response.status_code, 200, response.content)
+        resources = json.loads(response.content)
+        tools.assert_equals([r["content_id"] for r in resources["data"]], [self.author.pk])
+
+    def __login(self, username, password):
+        response = self.client.post('/admin-api/login/',
+            data={"username": username, "password": password})
+        tools.assert_equals(response.status_code, 200)
+        return {
+            "HTTP_AUTHORIZATION": "ApiKey %s:%s" % (username, json.loads(response.content)["api_key"]),
+        }
@@ -1,13 +1,27 @@
+import time
 import datetime
 import django.utils.simplejson as json
 
 from nose import tools
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Permission
+from django.core.cache import cache
 from django.test import TestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
 from tastypie.models import ApiKey
 
-from ella_hub import conf
+from ella_hub import conf, auth as auth_module
+from ella_hub.auth import ApiAuthentication, flush_api_key_refreshes
+from ella_hub.auth import SignedTokenAuthentication, create_signed_token, revoke_signed_tokens
+from ella_hub.auth import get_api_key_cache_key, get_revocation_cache_key
+
+
+class FastClock(object):
+    """Replaces time module in ella_hub.auth."""
+    def __init__(self, offset):
+        self.offset = offset
+
+    def time(self):
+        return time.time() + self.offset
 
 
 class TestAuthentication(TestCase):
@@ -167,6 +181,97 @@ class TestAuthentication(TestCase):
 
         self.__logout(headers)
 
+    def test_api_key_verification_cached(self):
+        api_key = self.__login("user", "pass")
+        request = RequestFactory().get("/admin-api/article/",
+            **self.__build_headers("user", api_key))
+        authentication = ApiAuthentication()
+
+        tools.assert_true(authentication.is_authenticated(request))
+
+        # only expiration time is refreshed
+        with self.assertNumQueries(1):
+            tools.assert_true(authentication.is_authenticated(request))
+        tools.assert_equals(request.user, self.user)
+
+    def test_api_key_invalidated_in_other_process(self):
+        api_key = self.__login("user", "pass")
+        request = RequestFactory().get("/admin-api/article/",
+            **self.__build_headers("user", api_key))
+        authentication = ApiAuthentication()
+
+        tools.assert_true(authentication.is_authenticated(request))
+
+        # other process regenerates the key, signals aren't sent in this one
+        ApiKey.objects.filter(user=self.user).update(key="regenerated")
+        cache.delete(get_api_key_cache_key("user", api_key))
+
+        tools.assert_not_equals(authentication.is_authenticated(request), True)
+
+    def test_api_key_refresh_coalesced(self):
+        api_key = self.__login("user", "pass")
+        request = RequestFactory().get("/admin-api/article/",
+            **self.__build_headers("user", api_key))
+        authentication = ApiAuthentication()
+
+        refresh_interval = conf.API_KEY_REFRESH_INTERVAL
+        conf.API_KEY_REFRESH_INTERVAL = 5 * 60
+        try:
+            old_created = ApiKey.objects.get(user=self.user).created - datetime.timedelta(hours=1)
+            ApiKey.objects.filter(user=self.user).update(created=old_created)
+            tools.assert_true(authentication.is_authenticated(request))
+
+            # refresh is deferred and repeated requests don't write
+            with self.assertNumQueries(0):
+                tools.assert_true(authentication.is_authenticated(request))
+                tools.assert_true(authentication.is_authenticated(request))
+
+            tools.assert_equals(ApiKey.objects.get(user=self.user).created, old_created)
+
+            with self.assertNumQueries(1):
+                tools.assert_equals(flush_api_key_refreshes(), 1)
+
+            tools.assert_true(ApiKey.objects.get(user=self.user).created > old_created)
+        finally:
+            conf.API_KEY_REFRESH_INTERVAL = refresh_interval
+
+    def test_user_permissions_cached(self):
+        self.user.is_superuser = False
+        self.user.save()
+        self.user.user_permissions.add(Permission.objects.get(codename="change_article"))
+
+        api_key = self.__login("user", "pass")
+        request = RequestFactory().get("/admin-api/article/",
+            **self.__build_headers("user", api_key))
+        authentication = ApiAuthentication()
+
+        tools.assert_true(authentication.is_authenticated(request))
+        with self.assertNumQueries(0):
+            tools.assert_true(request.user.has_perm("articles.change_article"))
+
+        # cached permissions are loaded to the new user object
+        tools.assert_true(authentication.is_authenticated(request))
+        with self.assertNumQueries(0):
+            tools.assert_true(request.user.has_perm("articles.change_article"))
+            tools.assert_false(request.user.has_perm("articles.delete_article"))
+
+        self.user.user_permissions.clear()
+        tools.assert_true(authentication.is_authenticated(request))
+        tools.assert_false(request.user.has_perm("articles.change_article"))
+
+    def test_deactivated_user_unauthorized(self):
+        api_key = self.__login("user", "pass")
+        headers = self.__build_headers("user", api_key)
+
+        response = self.client.get("/admin-api/article/", **headers)
+        tools.assert_equals(response.status_code, 200)
+
+        self.user.is_active = False
+        self.user.save()
+
+        response = self.client.get("/admin-api/article/", **headers)
+        tools.assert_equals(response.status_code, 401)
+
     def test_unauthorized_with_wrong_credentials(self):
         """
         Return "401 Unauthorized" header to user with wrong credetials.
@@ -220,3 +325,82 @@ class TestAuthentication(TestCase):
 
     def __get_response_json(self, response):
         return json.loads(response.content)
+
+
+class TestSignedTokenAuthentication(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="user", password="pass")
+        self.authentication = SignedTokenAuthentication()
+
+    def tearDown(self):
+        self.user.delete()
+
+    def test_valid_token_without_queries(self):
+        request = self.__build_request("user", create_signed_token(self.user))
+        tools.assert_true(self.authentication.is_authenticated(request))
+
+        with self.assertNumQueries(0):
+            tools.assert_true(self.authentication.is_authenticated(request))
+        tools.assert_equals(request.user, self.user)
+
+    def test_invalid_tokens(self):
+        token = create_signed_token(self.user)
+
+        TEST_CASES = (
+            # username, token
+            ("use", token), # wrong username
+            ("user", token[:-1]), # tampered token
+            ("user", "spinach"), # not a token
+        )
+
+        for username, token in TEST_CASES:
+            request = self.__build_request(username, token)
+            tools.assert_not_equals(self.authentication.is_authenticated(request), True)
+
+    def test_expired_token(self):
+        expiration = conf.API_KEY_EXPIRATION_IN_DAYS
+        conf.API_KEY_EXPIRATION_IN_DAYS = 0
+        try:
+            token = create_signed_token(self.user)
+        finally:
+            conf.API_KEY_EXPIRATION_IN_DAYS = expiration
+
+        request = self.__build_request("user", token)
+        tools.assert_not_equals(self.authentication.is_authenticated(request), True)
+
+    def test_revoked_token(self):
+        request = self.__build_request("user", create_signed_token(self.user))
+        tools.assert_true(self.authentication.is_authenticated(request))
+
+        revoke_signed_tokens(self.user)
+        tools.assert_not_equals(self.authentication.is_authenticated(request), True)
+
+        # tokens issued after revocation are valid
+        request = self.__build_request("user", create_signed_token(self.user))
+        tools.assert_true(self.authentication.is_authenticated(request))
+
+    def test_revocation_survives_cache_eviction(self):
+        request = self.__build_request("user", create_signed_token(self.user))
+        revoke_signed_tokens(self.user)
+
+        cache.delete(get_revocation_cache_key(self.user.pk))
+        tools.assert_not_equals(self.authentication.is_authenticated(request), True)
+
+        # revocation is read through the cache
+        with self.assertNumQueries(0):
+            tools.assert_not_equals(self.authentication.is_authenticated(request), True)
+
+    def test_revocation_independent_of_clock(self):
+        # token issued by node with fast clock just before logout
+        auth_module.time = FastClock(60)
+        try:
+            request = self.__build_request("user", create_signed_token(self.user))
+        finally:
+            auth_module.time = time
+        revoke_signed_tokens(self.user)
+
+        tools.assert_not_equals(self.authentication.is_authenticated(request), True)
+
+    def __build_request(self, username, token):
+        return RequestFactory().get("/admin-api/article/",
+            HTTP_AUTHORIZATION="ApiKey %s:%s" % (username, token))
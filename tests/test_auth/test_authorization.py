@@ -5,7 +5,7 @@ from PIL import Image
 from urlparse import urlparse, urlsplit
 from nose import tools
 from django.conf import settings
-from django.contrib.auth.models import User, Group
+from django.contrib.auth.models import User, Group, Permission as AuthPermission
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.db import connection
@@ -16,9 +16,10 @@ from ella.articles.models import Article
 from ella.core.models import Author
 
 from ella_hub import utils
+from ella_hub.auth import ApiAuthorization
 from ella_hub.utils import get_all_resource_classes
 from ella_hub.utils.workflow import init_ella_workflow, set_state
-from ella_hub.utils.perms import grant_permission
+from ella_hub.utils.perms import grant_permission, add_object_role
 from ella_hub.utils.test_helpers import create_basic_workflow, delete_test_workflow
 from ella_hub.models import Permission, Role, PrincipalRoleRelation, ModelPermission
 from ella_hub.models import Workflow, State, Transition, StateObjectRelation, StatePermissionRelation
@@ -294,6 +295,134 @@ class TestAuthorization(TestCase):
 
         self.__logout(headers)
 
+    def test_object_role_perms(self):
+        """
+        User without model permissions sees only objects of his object-scoped roles.
+        """
+        own_author = Author.objects.create(id=100, name="own_author", slug="own")
+        other_author = Author.objects.create(id=101, name="other_author", slug="other")
+        group = Group.objects.create(name="Freelancers")
+        group_author = Author.objects.create(id=102, name="group_author", slug="group")
+
+        add_object_role(self.banned_user, self.test_role, own_author)
+        add_object_role(group, self.test_role, group_author)
+        self.banned_user.groups.add(group)
+        # object roles grant permissions of object's state
+        set_state(own_author, self.state1)
+        set_state(group_author, self.state3)
+
+        api_key = self.__login("banned_user", "pass2")
+        headers = self.__build_headers("banned_user", api_key)
+
+        response = self.client.get("/admin-api/author/", **headers)
+        tools.assert_equals(response.status_code, 200)
+        resources = self.__get_response_json(response)
+        tools.assert_equals(sorted(r["id"] for r in resources["data"]), [own_author.id, group_author.id])
+
+        response = self.client.get("/admin-api/author/100/", **headers)
+        tools.assert_equals(response.status_code, 200)
+
+        response = self.client.get("/admin-api/author/101/", **headers)
+        tools.assert_equals(response.status_code, 401)
+
+        response = self.client.get("/admin-api/site/", **headers)
+        tools.assert_equals(response.status_code, 401)
+
+        group.delete()
+
+    def test_object_role_edit_perms(self):
+        """
+        Object-scoped roles allow editing and deleting objects in states
+        where the role has the permission.
+        """
+        own_author = Author.objects.create(id=100, name="own_author", slug="own")
+        Author.objects.create(id=101, name="other_author", slug="other")
+        locked_author = Author.objects.create(id=102, name="locked_author", slug="locked")
+
+        add_object_role(self.banned_user, self.test_role, own_author)
+        add_object_role(self.banned_user, self.test_role, locked_author)
+        set_state(own_author, self.state1)
+        set_state(locked_author, self.state3)
+
+        api_key = self.__login("banned_user", "pass2")
+        headers = self.__build_headers("banned_user", api_key)
+
+        response = self.client.patch("/admin-api/author/100/", data=json.dumps({"name": "renamed"}),
+            content_type='application/json', **headers)
+        tools.assert_equals(response.status_code, 202)
+        tools.assert_equals(Author.objects.get(pk=100).name, "renamed")
+
+        for author_id in (101, 102):
+            response = self.client.patch("/admin-api/author/%d/" % author_id,
+                data=json.dumps({"name": "renamed"}), content_type='application/json', **headers)
+            tools.assert_equals(response.status_code, 401)
+
+            response = self.client.delete("/admin-api/author/%d/" % author_id, **headers)
+            tools.assert_equals(response.status_code, 401)
+
+        response = self.client.delete("/admin-api/author/100/", **headers)
+        tools.assert_equals(response.status_code, 204)
+
+    def test_list_filtered_by_states(self):
+        """
+        User sees only objects in states his roles can view.
+        """
+        authors = [Author.objects.create(id=100 + i, name="author %d" % i, slug="author-%d" % i)
+            for i in range(4)]
+        for author, state in zip(authors, (self.state1, self.state2, self.state3, self.state3)):
+            set_state(author, state)
+        StatePermissionRelation.objects.filter(state=self.state3, permission=self.can_view).delete()
+        self.role_user.user_permissions.add(AuthPermission.objects.get(codename="change_author"))
+
+        api_key = self.__login("user", "pass3")
+        headers = self.__build_headers("user", api_key)
+
+        ApiAuthorization.state_read_permission = "can_view"
+        try:
+            response = self.client.get("/admin-api/author/?limit=1", **headers)
+            tools.assert_equals(response.status_code, 200)
+            resources = self.__get_response_json(response)
+            tools.assert_equals([r["id"] for r in resources["data"]], [100])
+            tools.assert_equals(resources["meta"]["total_count"], 2)
+
+            response = self.client.get("/admin-api/author/?offset=1&limit=1", **headers)
+            resources = self.__get_response_json(response)
+            tools.assert_equals([r["id"] for r in resources["data"]], [101])
+            tools.assert_equals(resources["meta"]["next"], None)
+        finally:
+            ApiAuthorization.state_read_permission = None
+
+        response = self.client.get("/admin-api/author/", **headers)
+        resources = self.__get_response_json(response)
+        tools.assert_equals(resources["meta"]["total_count"], 4)
+
+    def test_list_includes_stateless_objects(self):
+        """
+        Objects without state are listed as objects in initial state.
+        """
+        self.workflow.save()
+        stateless = Author.objects.create(id=100, name="stateless", slug="stateless")
+        in_state3 = Author.objects.create(id=101, name="in state 3", slug="in-state-3")
+        set_state(in_state3, self.state3)
+        self.role_user.user_permissions.add(AuthPermission.objects.get(codename="change_author"))
+
+        api_key = self.__login("user", "pass3")
+        headers = self.__build_headers("user", api_key)
+
+        ApiAuthorization.state_read_permission = "can_view"
+        try:
+            response = self.client.get("/admin-api/author/", **headers)
+            resources = self.__get_response_json(response)
+            tools.assert_equals(sorted(r["id"] for r in resources["data"]), [stateless.id, in_state3.id])
+
+            # initial state isn't readable
+            StatePermissionRelation.objects.filter(state=self.state1, permission=self.can_view).delete()
+            response = self.client.get("/admin-api/author/", **headers)
+            resources = self.__get_response_json(response)
+            tools.assert_equals([r["id"] for r in resources["data"]], [in_state3.id])
+        finally:
+            ApiAuthorization.state_read_permission = None
+
     def test_top_level_schema_auth(self):
         api_key = self.__login("banned_user", "pass2")
         headers = self.__build_headers("banned_user", api_key)
@@ -1,14 +1,29 @@
 from nose import tools
 from django.test import TestCase
 from django.contrib.auth.models import User, AnonymousUser, Group
+from django.db.models import signals
 from django.test.client import Client
 from ella.core.models import Author
 from ella.articles.models import Article
-from ella_hub.models import Permission, Role
+from ella_hub.models import Permission, Role, State, StatePermissionRelation, Workflow
+from ella_hub.models import ModelPermission, PrincipalRoleRelation
+from ella_hub.signals import invalidate_permissions_cache, invalidate_user_roles_cache
 from ella_hub.utils.perms import (has_model_state_permission,
     has_object_permission, grant_permission)
 from ella_hub.utils.perms import (add_role, get_roles,
     remove_role, remove_roles)
+from ella_hub.utils.perms import get_permission_matrix, get_effective_role_ids
+from ella_hub.utils.perms import add_object_role, get_permitted_object_ids
+from ella_hub.utils.perms import (bulk_grant_permissions, bulk_revoke_permissions,
+    bulk_add_roles, bulk_remove_roles)
+from ella_hub.utils.workflow import get_init_states, set_state
+
+
+def is_connected(signal, receiver, sender):
+    """
+    Returns True if <receiver> is connected to <signal> sent by <sender>.
+    """
+    return (id(receiver), id(sender)) in [key for key, _ in signal.receivers]
 
 
 class TestPermUtils(TestCase):
@@ -71,6 +86,195 @@ class TestPermUtils(TestCase):
         tools.assert_equals(has_model_state_permission(Article, self.user,
             "test_perm"), True)
 
+    def test_permission_matrix_rebuilt(self):
+        matrix = get_permission_matrix()
+        tools.assert_true(get_permission_matrix() is matrix)
+
+        add_role(self.user, self.role)
+        grant_permission(Article, self.role, "test_perm")
+        tools.assert_false(get_permission_matrix() is matrix)
+
+        state = State.objects.create(title="Test state", codename="test_state")
+        tools.assert_equals(has_model_state_permission(Article, self.user,
+            "test_perm", state), False)
+
+        StatePermissionRelation.objects.create(state=state,
+            permission=self.perm, role=self.role)
+        tools.assert_equals(has_model_state_permission(Article, self.user,
+            "test_perm", state), True)
+        tools.assert_equals(has_model_state_permission(Author, self.user,
+            "test_perm", state), False)
+        state.delete()
+
+    def test_matrix_signals_connected(self):
+        for model in (Role, Permission, ModelPermission, StatePermissionRelation):
+            tools.assert_true(is_connected(signals.post_save, invalidate_permissions_cache, model))
+            tools.assert_true(is_connected(signals.post_delete, invalidate_permissions_cache, model))
+
+    def test_init_states_from_matrix(self):
+        state = State.objects.create(title="Test state", codename="test_state")
+        StatePermissionRelation.objects.create(state=state,
+            permission=self.perm, role=self.role)
+        grant_permission(Article, self.role, "test_perm")
+        workflow = Workflow.objects.create(title="Test workflow")
+        workflow.set_to_model(Article)
+
+        tools.assert_equals(get_init_states(Article, self.user), [])
+        add_role(self.user, self.role)
+        tools.assert_equals(get_init_states(Article, self.user), [state])
+        tools.assert_equals(get_init_states(Author, self.user), [])
+
+        with self.assertNumQueries(0):
+            get_init_states(Article, self.user)
+
+        workflow.delete()
+        state.delete()
+
+    def test_effective_roles_include_group_roles(self):
+        second_role = Role.objects.create(title="Second role")
+        add_role(self.user, self.role)
+        add_role(self.group, second_role)
+
+        tools.assert_equals(get_effective_role_ids(User.objects.get(pk=self.user.pk)),
+            set([self.role.pk]))
+
+        self.user.groups.add(self.group)
+        tools.assert_equals(get_effective_role_ids(User.objects.get(pk=self.user.pk)),
+            set([self.role.pk, second_role.pk]))
+
+        # cached until roles change
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            get_effective_role_ids(user)
+
+        remove_role(self.group, second_role)
+        tools.assert_equals(get_effective_role_ids(User.objects.get(pk=self.user.pk)),
+            set([self.role.pk]))
+
+        second_role.delete()
+
+    def test_init_states_of_group_role(self):
+        state = State.objects.create(title="Test state", codename="test_state")
+        StatePermissionRelation.objects.create(state=state,
+            permission=self.perm, role=self.role)
+        grant_permission(Article, self.role, "test_perm")
+        workflow = Workflow.objects.create(title="Test workflow")
+        workflow.set_to_model(Article)
+
+        add_role(self.group, self.role)
+        self.user.groups.add(self.group)
+        tools.assert_equals(get_init_states(Article, User.objects.get(pk=self.user.pk)), [state])
+        tools.assert_equals(has_model_state_permission(Article,
+            User.objects.get(pk=self.user.pk), "test_perm", state), True)
+
+        workflow.delete()
+        state.delete()
+
+    def test_role_signals_connected(self):
+        tools.assert_true(is_connected(signals.post_save, invalidate_user_roles_cache, PrincipalRoleRelation))
+        tools.assert_true(is_connected(signals.post_delete, invalidate_user_roles_cache, PrincipalRoleRelation))
+        tools.assert_true(is_connected(signals.m2m_changed, invalidate_user_roles_cache, User.groups.through))
+
+    def test_bulk_grant_and_revoke_permissions(self):
+        second_role = Role.objects.create(title="Second role")
+        grant_permission(Article, self.role, "test_perm")
+
+        items = [
+            (Article, self.role, "test_perm"),
+            (Author, self.role, self.perm),
+            (Article, second_role, "test_perm"),
+            (Article, second_role, "can_whatever"),
+        ]
+        tools.assert_equals(bulk_grant_permissions(items), 2)
+        tools.assert_equals(bulk_grant_permissions(items), 0)
+        tools.assert_equals(ModelPermission.objects.filter(permission=self.perm).count(), 3)
+
+        add_role(self.user, second_role)
+        tools.assert_equals(has_model_state_permission(Article, self.user, "test_perm"), True)
+
+        tools.assert_equals(bulk_revoke_permissions(items[1:]), 2)
+        tools.assert_equals(ModelPermission.objects.filter(permission=self.perm).count(), 1)
+        tools.assert_equals(has_model_state_permission(Article, self.user, "test_perm"), False)
+
+        second_role.delete()
+
+    def test_bulk_add_and_remove_roles(self):
+        second_role = Role.objects.create(title="Second role")
+        add_role(self.user, self.role)
+
+        items = [
+            (self.user, self.role),
+            (self.user, second_role),
+            (self.group, self.role),
+        ]
+        tools.assert_equals(bulk_add_roles(items), 2)
+        tools.assert_equals(bulk_add_roles(items), 0)
+        tools.assert_equals(set(get_roles(self.user)), set([self.role, second_role]))
+        tools.assert_equals(get_roles(self.group), [self.role])
+        tools.assert_equals(get_effective_role_ids(User.objects.get(pk=self.user.pk)),
+            set([self.role.pk, second_role.pk]))
+
+        tools.assert_equals(bulk_remove_roles(items[1:]), 2)
+        tools.assert_equals(get_roles(self.user), [self.role])
+        tools.assert_equals(get_roles(self.group), [])
+        tools.assert_equals(get_effective_role_ids(User.objects.get(pk=self.user.pk)),
+            set([self.role.pk]))
+
+        second_role.delete()
+
+    def test_object_roles(self):
+        authors = [Author.objects.create(name="Author %d" % i, slug="author-%d" % i)
+            for i in range(3)]
+        grant_permission(Author, self.role, "test_perm")
+        add_object_role(self.user, self.role, authors[0])
+        add_object_role(self.group, self.role, authors[1])
+        self.user.groups.add(self.group)
+
+        ids = [author.pk for author in authors]
+        get_permission_matrix()
+        with self.assertNumQueries(1):
+            permitted = get_permitted_object_ids(self.user, Author, "test_perm", ids)
+        tools.assert_equals(permitted, set(ids[:2]))
+
+        tools.assert_equals(has_object_permission(authors[0], self.user, "change", "test_perm"), True)
+        tools.assert_equals(has_object_permission(authors[0], self.user, "change"), False)
+        tools.assert_equals(has_object_permission(authors[2], self.user, "change", "test_perm"), False)
+        tools.assert_equals(has_model_state_permission(Author, self.user, "test_perm"), False)
+
+        for author in authors:
+            author.delete()
+
+    def test_object_roles_in_states(self):
+        authors = [Author.objects.create(name="Author %d" % i, slug="author-%d" % i)
+            for i in range(3)]
+        workflow = Workflow.objects.create(title="Test workflow")
+        workflow.set_to_model(Author)
+        states = [State.objects.create(title="State %d" % i, codename="state_%d" % i,
+            workflow=workflow) for i in range(2)]
+        StatePermissionRelation.objects.create(state=states[0],
+            permission=self.perm, role=self.role)
+        for author in authors:
+            add_object_role(self.user, self.role, author)
+        set_state(authors[0], states[0])
+        set_state(authors[1], states[1])
+
+        # granted by state of the object, not by model permissions
+        grant_permission(Author, self.role, "test_perm")
+        ids = [author.pk for author in authors]
+        tools.assert_equals(get_permitted_object_ids(self.user, Author, "test_perm", ids), set(ids[:1]))
+
+        set_state(authors[1], states[0])
+        tools.assert_equals(get_permitted_object_ids(self.user, Author, "test_perm", ids), set(ids[:2]))
+
+        # object without state is in initial state
+        workflow.initial_state = states[0]
+        workflow.save()
+        tools.assert_equals(get_permitted_object_ids(self.user, Author, "test_perm", ids), set(ids))
+
+        for author in authors:
+            author.delete()
+        workflow.delete()
+
     def test_add_role(self):
         add_role(self.user, self.role)
         tools.assert_equals(self.role in get_roles(self.user), True)
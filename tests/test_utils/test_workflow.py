@@ -1,12 +1,33 @@
+import time
+import threading
+from datetime import timedelta
+
 from nose import tools
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction, IntegrityError
+from django.db.models import signals
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User, AnonymousUser, Group
 from django.test.client import Client
 
+from ella.articles.models import Article
 from ella.core.models import Author
+from ella.utils.test_helpers import create_basic_categories
+from ella.utils.timezone import now
 
-from ella_hub.models import Workflow, State
-from ella_hub.utils.workflow import set_state, get_state
+from ella_hub.models import Workflow, State, Transition, Role, Permission
+from ella_hub.models import ModelPermission, StatePermissionRelation, WorkflowPermissionRelation
+from ella_hub.models import StateCount, StateObjectRelation, ScheduledTransition, WorkflowModelRelation
+from ella_hub.signals import invalidate_permissions_cache
+from ella_hub.utils.cache import VersionedCache, get_cache_version, bump_cache_version
+from ella_hub.utils.perms import PERMISSIONS_VERSION_KEY
+from ella_hub.utils.workflow import set_state, set_states, get_state, get_allowed_states
+from ella_hub.utils.workflow import get_state_counts, rebuild_state_counts, get_states, state_map
+from ella_hub.utils.workflow import reconcile_published_states, update_permissions
+from ella_hub.utils.workflow import schedule_state, process_scheduled_transitions
+from ella_hub.utils.workflow import load_workflow, get_workflow, get_init_states, WORKFLOWS_VERSION_KEY
 
 
 class TestWorkflowUtils(TestCase):
@@ -31,9 +52,388 @@ class TestWorkflowUtils(TestCase):
         set_state(self.author, self.state2)
         tools.assert_equals(get_state(self.author), self.state2)
 
+    def test_one_state_per_object(self):
+        set_state(self.author, self.state1)
+        set_state(self.author, self.state2)
+        set_state(self.author, self.state1)
+
+        content_type = ContentType.objects.get_for_model(Author)
+        relations = StateObjectRelation.objects.filter(content_type=content_type,
+            content_id=self.author.pk)
+        tools.assert_equals([r.state for r in relations], [self.state1])
+
+        with tools.assert_raises(IntegrityError):
+            with transaction.atomic():
+                StateObjectRelation.objects.create(content_type=content_type,
+                    content_id=self.author.pk, state=self.state2)
+
     def test_get_state(self):
         tools.assert_equals(get_state(self.author), None)
 
+    def test_states_remembered_during_request(self):
+        author_two = Author.objects.create(name="2nd author", slug="2nd")
+        set_state(self.author, self.state1)
+
+        state_map.start()
+        try:
+            tools.assert_equals(get_state(self.author), self.state1)
+            with self.assertNumQueries(0):
+                tools.assert_equals(get_state(self.author), self.state1)
+
+            with self.assertNumQueries(1):
+                tools.assert_equals(get_states(Author, [self.author.pk, author_two.pk]),
+                    {self.author.pk: self.state1, author_two.pk: None})
+
+            set_state(author_two, self.state2)
+            with self.assertNumQueries(0):
+                tools.assert_equals(get_state(author_two), self.state2)
+        finally:
+            state_map.finish()
+
+        # outside of request states are always read from database
+        StateObjectRelation.objects.all().delete()
+        tools.assert_equals(get_state(self.author), None)
+        author_two.delete()
+
+    def test_set_state_updates_permissions_incrementally(self):
+        # workflow of model may be cached by previous tests
+        cache.clear()
+        self.workflow.set_to_model(Author)
+        role = Role.objects.create(title="Test role")
+        can_view = Permission.objects.create(title="Can view", codename="test_view")
+        can_change = Permission.objects.create(title="Can change", codename="test_change")
+        for perm in (can_view, can_change):
+            WorkflowPermissionRelation.objects.create(workflow=self.workflow, permission=perm)
+            StatePermissionRelation.objects.create(state=self.state1, permission=perm, role=role)
+        StatePermissionRelation.objects.create(state=self.state2, permission=can_view, role=role)
+
+        set_state(self.author, self.state1)
+        relations = ModelPermission.objects.filter(role=role)
+        tools.assert_equals(set(r.permission for r in relations), set([can_view, can_change]))
+        view_pk = relations.get(permission=can_view).pk
+
+        set_state(self.author, self.state2)
+        relations = ModelPermission.objects.filter(role=role)
+        tools.assert_equals([r.permission for r in relations], [can_view])
+        # unchanged permission isn't rewritten
+        tools.assert_equals(relations[0].pk, view_pk)
+
+        role.delete()
+        can_view.delete()
+        can_change.delete()
+
+    def test_allowed_states(self):
+        self.workflow.set_to_model(Author)
+        self.workflow.initial_state = self.state1
+        self.workflow.save()
+        state3 = State.objects.create(title="Test state 3", codename="test_3")
+        to_state2 = Transition.objects.create(title="to 2", workflow=self.workflow,
+            destination=self.state2)
+        to_state3 = Transition.objects.create(title="to 3", workflow=self.workflow,
+            destination=state3)
+        self.state1.transitions.add(to_state2)
+        self.state2.transitions.add(to_state3)
+
+        tools.assert_equals(get_allowed_states(Author, None),
+            {"test_1": "Test state 1", "test_2": "Test state 2"})
+        tools.assert_equals(get_allowed_states(Author, self.state2), {"test_3": "Test state 3"})
+
+        with self.assertNumQueries(0):
+            get_allowed_states(self.author, self.state1)
+
+        self.state1.transitions.add(to_state3)
+        tools.assert_equals(get_allowed_states(Author, self.state1),
+            {"test_2": "Test state 2", "test_3": "Test state 3"})
+
+    def test_state_counts(self):
+        self.workflow.set_to_model(Article)
+        create_basic_categories(self)
+        articles = [
+            Article.objects.create(title="Article %d" % i, slug="article-%d" % i,
+                category=category, publish_from=now(), published=False)
+            for i, category in enumerate([self.category, self.category, self.category_nested])
+        ]
+        self.state1.transitions.add(Transition.objects.create(title="to 2",
+            workflow=self.workflow, destination=self.state2))
+
+        set_states(Article, [a.pk for a in articles], self.state1, force=True)
+        set_state(articles[0], self.state2)
+        set_state(self.author, self.state2)
+
+        counts = {"test_1": 2, "test_2": 1}
+        tools.assert_equals(get_state_counts(Article), counts)
+        tools.assert_equals(get_state_counts(Article, self.category), {"test_1": 1, "test_2": 1})
+
+        with self.assertNumQueries(1):
+            get_state_counts(Article)
+
+        # moved to other category
+        articles[1].category = self.category_nested
+        articles[1].save()
+        tools.assert_equals(get_state_counts(Article, self.category_nested), {"test_1": 2})
+
+        articles[2].delete()
+        tools.assert_equals(get_state_counts(Article), {"test_1": 1, "test_2": 1})
+
+        StateCount.objects.all().delete()
+        tools.assert_equals(rebuild_state_counts(), 3)
+        tools.assert_equals(get_state_counts(Article), {"test_1": 1, "test_2": 1})
+        tools.assert_equals(get_state_counts(Article, self.category_nested), {"test_1": 1})
+        tools.assert_equals(get_state_counts(Author), {"test_1": 0, "test_2": 1})
+
+        # counters of objects without category are unique too
+        with tools.assert_raises(IntegrityError):
+            with transaction.atomic():
+                StateCount.objects.create(content_type=ContentType.objects.get_for_model(Author),
+                    state=self.state2, count=1)
+
+        Article.objects.all().delete()
+
+    def test_state_signals_of_workflow_models(self):
+        # connected without any request
+        self.workflow.set_to_model(Author)
+        author = Author.objects.create(name="Other author", slug="other-author")
+        set_state(author, self.state1)
+        author.delete()
+        tools.assert_equals(get_state_counts(Author), {"test_1": 0})
+        tools.assert_false(StateObjectRelation.objects.filter(
+            content_type=ContentType.objects.get_for_model(Author), content_id=author.pk).exists())
+
+        # model without workflow is skipped without queries
+        user = User.objects.create(username="other")
+        with self.assertNumQueries(0):
+            signals.pre_save.send(sender=User, instance=user)
+        user.delete()
+
+    def test_reconcile_published_states(self):
+        create_basic_categories(self)
+        # published state of other workflow isn't used
+        State.objects.create(title="Published", codename="published")
+        published = State.objects.create(title="Published", codename="published", workflow=self.workflow)
+        articles = [
+            Article.objects.create(title="Article %d" % i, slug="article-%d" % i,
+                category=self.category, publish_from=now(), published=i > 0)
+            for i in range(3)
+        ]
+        set_state(articles[0], self.state1)
+        set_state(articles[1], self.state1)
+
+        # model without workflow is skipped
+        tools.assert_equals(reconcile_published_states(), 0)
+
+        self.workflow.set_to_model(Article)
+        tools.assert_equals(reconcile_published_states(), 2)
+        tools.assert_equals([get_state(a) for a in articles], [self.state1, published, published])
+        tools.assert_equals(reconcile_published_states(), 0)
+
+        Article.objects.all().delete()
+
+    def test_scheduled_transitions(self):
+        self.workflow.initial_state = self.state1
+        self.workflow.save()
+        self.workflow.set_to_model(Author)
+        self.state1.transitions.add(Transition.objects.create(title="to 2",
+            workflow=self.workflow, destination=self.state2))
+        authors = [Author.objects.create(name="Author %d" % i, slug="author-%d" % i) for i in range(5)]
+        for author in authors[:4]:
+            set_state(author, self.state1)
+        set_state(authors[3], self.state2)
+
+        for author in authors:
+            schedule_state(author, self.state2, now() - timedelta(minutes=1))
+        schedule_state(authors[0], self.state1, now() + timedelta(minutes=1))
+
+        # the last author has no state yet, it goes through initial state
+        tools.assert_equals(process_scheduled_transitions(batch_size=2), (5, 0))
+        tools.assert_equals([get_state(a) for a in authors], [self.state2] * 5)
+        tools.assert_equals(ScheduledTransition.objects.count(), 1)
+
+        # state 2 doesn't lead to state 1, failed transition is kept with its error
+        tools.assert_equals(process_scheduled_transitions(until=now() + timedelta(minutes=2)), (0, 1))
+        tools.assert_equals(get_state(authors[0]), self.state2)
+        tools.assert_equals(list(ScheduledTransition.objects.values_list('content_id', 'error')),
+            [(authors[0].pk, "Transition to state test_1 is not allowed.")])
+
+        # and it isn't applied again
+        tools.assert_equals(process_scheduled_transitions(until=now() + timedelta(minutes=2)), (0, 0))
+        ScheduledTransition.objects.all().delete()
+
+        for author in authors:
+            author.delete()
+
+    def test_scheduled_transitions_in_due_order(self):
+        state3 = State.objects.create(title="Test state 3", codename="test_3")
+        self.workflow.set_to_model(Author)
+        self.state1.transitions.add(Transition.objects.create(title="to 2",
+            workflow=self.workflow, destination=self.state2))
+        self.state2.transitions.add(Transition.objects.create(title="to 3",
+            workflow=self.workflow, destination=state3))
+        first, second = [Author.objects.create(name="Author %d" % i, slug="author-%d" % i) for i in range(2)]
+        set_state(first, self.state2)
+        set_state(second, self.state1)
+
+        schedule_state(first, state3, now() - timedelta(minutes=30))
+        schedule_state(second, self.state2, now() - timedelta(minutes=20))
+        schedule_state(second, state3, now() - timedelta(minutes=10))
+
+        tools.assert_equals(process_scheduled_transitions(), (3, 0))
+        tools.assert_equals([get_state(first), get_state(second)], [state3, state3])
+
+        first.delete()
+        second.delete()
+
+    def test_scheduled_transitions_in_bulk(self):
+        self.workflow.set_to_model(Author)
+        self.state1.transitions.add(Transition.objects.create(title="to 2",
+            workflow=self.workflow, destination=self.state2))
+
+        # number of queries doesn't depend on number of transitions in batch,
+        # the first run fills caches and creates state counters
+        queries = []
+        for count in (1, 2, 20):
+            authors = [Author.objects.create(name="Author %d" % i, slug="author-%d" % i) for i in range(count)]
+            for author in authors:
+                set_state(author, self.state1)
+                schedule_state(author, self.state2, now() - timedelta(minutes=1))
+
+            with CaptureQueriesContext(connection) as context:
+                tools.assert_equals(process_scheduled_transitions(), (count, 0))
+            queries.append(len(context))
+            Author.objects.filter(pk__in=[a.pk for a in authors]).delete()
+
+        tools.assert_equals(queries[1], queries[2])
+
+    def test_load_workflow(self):
+        spec = {
+            "title": "Loaded workflow",
+            "states": [("draft", "Draft"), ("done", "Done")],
+            "initial_state": "draft",
+            "transitions": [("draft", "done"), ("done", "draft"), ("done", "done")],
+            "permissions": [("can_view", "Can view", False), ("can_add", "Can add", False)],
+            "roles": [{
+                "title": "Loader",
+                "models": {"*": ["can_view", "can_add"], "articles.article": ["can_view"]},
+                "states": {"*": ["can_view"], "draft": ["can_add"]},
+            }],
+        }
+        workflow, changes = load_workflow(spec, [Author])
+
+        tools.assert_equals(dict(changes), {
+            "workflows": 1,
+            "states": 2,
+            "initial states": 1,
+            "permissions": 2,
+            "roles": 1,
+            "transitions": 2,
+            "state transitions": 3,
+            "workflow permissions": 2,
+            "model permissions": 3,
+            "state permissions": 3,
+            "workflow models": 1,
+        })
+        tools.assert_equals(get_workflow(Author), workflow)
+        tools.assert_equals([s.codename for s in get_init_states(Author, self.user)], [])
+        draft = State.objects.get(workflow=workflow, codename="draft")
+        tools.assert_equals(workflow.initial_state, draft)
+        tools.assert_equals([t.destination.codename for t in draft.transitions.all()], ["done"])
+
+        # nothing is missing, so only existing rows are read (and savepoint is set)
+        with self.assertNumQueries(12):
+            workflow2, changes = load_workflow(spec, [Author])
+        tools.assert_equals(workflow2, workflow)
+        tools.assert_equals(sum(changes.values()), 0)
+
+        Role.objects.filter(title="Loader").delete()
+        Permission.objects.filter(codename__in=("can_view", "can_add")).delete()
+        workflow.delete()
+
+    def test_revoked_permissions_bump_version(self):
+        self.workflow.set_to_model(Author)
+        perm = Permission.objects.create(title="Test perm", codename="test_perm")
+        WorkflowPermissionRelation.objects.create(workflow=self.workflow, permission=perm)
+        ModelPermission.objects.create(role=Role.objects.create(title="Test role"),
+            permission=perm, content_type=ContentType.objects.get_for_model(Author))
+
+        version = get_cache_version(PERMISSIONS_VERSION_KEY)
+        signals.post_delete.disconnect(invalidate_permissions_cache, sender=ModelPermission)
+        try:
+            update_permissions(self.author, self.state1)
+        finally:
+            signals.post_delete.connect(invalidate_permissions_cache, sender=ModelPermission)
+
+        tools.assert_false(ModelPermission.objects.filter(permission=perm).exists())
+        tools.assert_not_equals(get_cache_version(PERMISSIONS_VERSION_KEY), version)
+
+    def test_workflow_cache(self):
+        tools.assert_false(get_workflow(Author))
+        relation = WorkflowModelRelation.objects.create(workflow=self.workflow,
+            content_type=ContentType.objects.get_for_model(Author))
+        tools.assert_equals(get_workflow(Author), self.workflow)
+
+        # permission changes don't invalidate workflows
+        version = get_cache_version(WORKFLOWS_VERSION_KEY)
+        ModelPermission.objects.create(role=Role.objects.create(title="Test role"),
+            permission=Permission.objects.create(title="Test perm", codename="test_perm"),
+            content_type=relation.content_type)
+        tools.assert_equals(get_cache_version(WORKFLOWS_VERSION_KEY), version)
+
+        relation.delete()
+        tools.assert_false(get_workflow(Author))
+
+    def test_expired_entry_recomputed_once(self):
+        calls = []
+        compute = lambda: calls.append(1) or len(calls)
+        versioned_cache = VersionedCache("HUB_test", "HUB_test_version",
+            timeout=60, local_timeout=10, local_size=10)
+        tools.assert_equals(versioned_cache.get_or_set("key", compute), 1)
+        tools.assert_equals(versioned_cache.get_or_set("key", compute), 1)
+
+        # other worker holds the lock, so stale value is served
+        shared_key = versioned_cache.make_key("key", get_cache_version("HUB_test_version", local=True))
+        versioned_cache.local.clear()
+        cache.set(shared_key, (time.time() - 1, 1))
+        cache.add(versioned_cache._lock_key(shared_key), 1)
+        tools.assert_equals(versioned_cache.get_or_set("key", compute), 1)
+
+        versioned_cache.local.clear()
+        cache.delete(versioned_cache._lock_key(shared_key))
+        tools.assert_equals(versioned_cache.get_or_set("key", compute), 2)
+        tools.assert_equals(versioned_cache.get_or_set("key", compute), 2)
+
+        versioned_cache.invalidate()
+        tools.assert_equals(versioned_cache.get_or_set("key", compute), 3)
+
+    def test_missing_entry_computed_once(self):
+        calls = []
+        compute = lambda: calls.append(1) or len(calls)
+        versioned_cache = VersionedCache("HUB_test", "HUB_test_version",
+            timeout=60, local_timeout=10, local_size=10, wait_timeout=1, poll_interval=0.01)
+        versioned_cache.invalidate()
+
+        # other worker computes the missing entry, this one waits for it
+        shared_key = versioned_cache.make_key("key", get_cache_version("HUB_test_version", local=True))
+        cache.add(versioned_cache._lock_key(shared_key), 1)
+        timer = threading.Timer(0.1, lambda: cache.set(shared_key, (time.time() + 60, "computed")))
+        timer.start()
+        tools.assert_equals(versioned_cache.get_or_set("key", compute), "computed")
+        timer.join()
+        tools.assert_equals(calls, [])
+
+        # entry didn't appear in time
+        versioned_cache.invalidate()
+        shared_key = versioned_cache.make_key("key", get_cache_version("HUB_test_version", local=True))
+        cache.add(versioned_cache._lock_key(shared_key), 1)
+        tools.assert_equals(versioned_cache.get_or_set("key", compute), 1)
+
+    def test_evicted_version_not_reused(self):
+        cache.delete("HUB_test_version")
+        version = get_cache_version("HUB_test_version")
+        for i in range(5):
+            bump_cache_version("HUB_test_version")
+
+        cache.delete("HUB_test_version")
+        tools.assert_true(get_cache_version("HUB_test_version") > version + 5)
+
     def __create_test_user(self, username, password, is_admin=False):
         user = User.objects.create_user(username=username, password=password)
         user.is_staff = True